@@ -0,0 +1,308 @@
+"""
+bench.py :: Loopback load generator for SSDP discovery and device control.
+
+Starts a fauxmo server in a child process on 127.0.0.1, backed by the
+testRPiGPIO stand-in, then floods it with M-SEARCH datagrams and concurrent
+setup.xml / SetBinaryState clients. Throughput, latency percentiles and the
+server's fd count and RSS are printed as JSON.
+
+    python bench.py --devices 14 --searches 500 --clients 16 --requests 200
+
+With --simulate, no server is started; instead one-shot pulses and all-off
+macros run in-process on the simulated GPIO backend with a virtual clock,
+and every pulse width and overlap is checked.
+
+    python bench.py --devices 14 --simulate 1000
+"""
+import argparse
+import asyncio
+import json
+import os
+import socket
+import subprocess
+import sys
+import time
+
+SEARCH = (b'M-SEARCH * HTTP/1.1\r\n'
+          b'HOST: 239.255.255.250:1900\r\n'
+          b'MAN: "ssdp:discover"\r\n'
+          b'MX: %d\r\n'
+          b'ST: urn:Belkin:device:**\r\n'
+          b'\r\n')
+
+SET_STATE_BODY = (b'<?xml version="1.0" encoding="utf-8"?>'
+                  b'<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/">'
+                  b'<s:Body><u:SetBinaryState xmlns:u="urn:Belkin:service:basicevent:1">'
+                  b'<BinaryState>%d</BinaryState>'
+                  b'</u:SetBinaryState></s:Body></s:Envelope>')
+
+
+def percentiles(samples) -> dict:
+    """Summarise latency samples (seconds) as milliseconds."""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def rank(p):
+        return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+    return {'count': len(samples), 'p50_ms': rank(0.50), 'p95_ms': rank(0.95), 'p99_ms': rank(0.99),
+            'max_ms': samples[-1] * 1000}
+
+
+def process_stats(pid: int) -> dict:
+    """Open fd count and resident set size of `pid`, where /proc allows."""
+    stats = {'fds': None, 'rss_kb': None}
+    try:
+        stats['fds'] = len(os.listdir('/proc/%d/fd' % pid))
+        with open('/proc/%d/status' % pid) as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    stats['rss_kb'] = int(line.split()[1])
+    except OSError:
+        pass
+    return stats
+
+
+async def run_server(args) -> None:
+    """Child process: serve `args.devices` devices on loopback until killed."""
+    # Keep stdout for the ready line only.
+    ready = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    import fauxmo
+
+    if args.ssdp_limits:
+        u = fauxmo.UPnPBroadcastResponder()
+    else:
+        # Every search comes from loopback; measure search handling, not the rate limits
+        u = fauxmo.UPnPBroadcastResponder(rate=1e9, burst=1e9, suppress=0)
+    u.init_socket(port=args.ssdp_port)
+    http_server = None
+    if args.http_port is not None:
+        http_server = fauxmo.UPnPHTTPServer('127.0.0.1', args.http_port)
+    devices = [fauxmo.Fauxmo('%d bench' % i, u, '127.0.0.1', 0, action_handler=fauxmo.GPIOOneShot(100 + i),
+                             http_server=http_server) for i in range(args.devices)]
+    await u.start()
+    if http_server:
+        await http_server.start()
+    for device in devices:
+        await device.start()
+
+    urls = [device.root_url % {'ip_address': device.ip_address, 'port': device.port,
+                               'path_prefix': device.path_prefix} for device in devices]
+    ready.write(json.dumps({'setup_urls': urls}) + '\n')
+    ready.flush()
+    await asyncio.get_running_loop().create_future()
+
+
+class SearchClient(asyncio.DatagramProtocol):
+    """One sender in the M-SEARCH flood; times each search until every device has replied."""
+
+    def __init__(self, expected: int, done) -> None:
+        self.expected = expected
+        self.done = done
+        self.sent = None
+        self.replies = 0
+        self.latencies = []
+
+    def datagram_received(self, data, addr) -> None:
+        self.replies += 1
+        if self.replies == self.expected:
+            self.latencies.append(time.perf_counter() - self.sent)
+            self.done.set()
+
+
+async def flood_searches(args) -> dict:
+    """Send `args.searches` searches from `args.senders` sockets and time the replies."""
+    loop = asyncio.get_running_loop()
+    per_sender = max(1, args.searches // args.senders)
+    clients = []
+
+    async def sender():
+        done = asyncio.Event()
+        transport, client = await loop.create_datagram_endpoint(
+            lambda: SearchClient(args.devices, done), local_addr=('127.0.0.1', 0))
+        clients.append(client)
+        for _ in range(per_sender):
+            done.clear()
+            client.replies = 0
+            client.sent = time.perf_counter()
+            transport.sendto(SEARCH % args.mx, ('127.0.0.1', args.ssdp_port))
+            try:
+                await asyncio.wait_for(done.wait(), args.mx + 2)
+            except asyncio.TimeoutError:
+                pass
+        transport.close()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(sender() for _ in range(args.senders)))
+    elapsed = time.perf_counter() - start
+    latencies = [latency for client in clients for latency in client.latencies]
+    result = {'searches': per_sender * args.senders, 'answered': len(latencies),
+              'searches_per_sec': len(latencies) / elapsed if elapsed else 0}
+    result.update(percentiles(latencies))
+    return result
+
+
+async def http_client(url: str, requests: int, keep_alive: bool, latencies, errors) -> None:
+    """Alternate setup.xml fetches and SetBinaryState calls against one device."""
+    host, port_path = url[len('http://'):].split(':', 1)
+    port, path = port_path.split('/', 1)
+    prefix = '/' + path[:-len('setup.xml')]
+    connection = b'keep-alive' if keep_alive else b'close'
+    reader = writer = None
+    for i in range(requests):
+        if i % 2:
+            body = SET_STATE_BODY % (i // 2 % 2)
+            request = (b'POST %supnp/control/basicevent1 HTTP/1.1\r\n'
+                       b'SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"\r\n'
+                       b'CONTENT-TYPE: text/xml; charset="utf-8"\r\n'
+                       b'CONTENT-LENGTH: %d\r\n'
+                       b'CONNECTION: %s\r\n'
+                       b'\r\n' % (prefix.encode(), len(body), connection)) + body
+        else:
+            request = b'GET %ssetup.xml HTTP/1.1\r\nCONNECTION: %s\r\n\r\n' % (prefix.encode(), connection)
+        start = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host, int(port))
+            writer.write(request)
+            head = await reader.readuntil(b'\r\n\r\n')
+            length = 0
+            for line in head.split(b'\r\n'):
+                if line.lower().startswith(b'content-length:'):
+                    length = int(line.split(b':', 1)[1])
+            await reader.readexactly(length)
+            if not head.startswith(b'HTTP/1.1 200'):
+                errors.append(head.split(b'\r\n', 1)[0].decode())
+            latencies.append(time.perf_counter() - start)
+        except (OSError, asyncio.IncompleteReadError) as err:
+            errors.append(str(err))
+            writer = None
+            continue
+        if not keep_alive:
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+async def drive_http(args, urls) -> dict:
+    """Run `args.clients` concurrent clients spread over the devices."""
+    latencies = []
+    errors = []
+    start = time.perf_counter()
+    await asyncio.gather(*(http_client(urls[i % len(urls)], args.requests, args.keep_alive, latencies, errors)
+                           for i in range(args.clients)))
+    elapsed = time.perf_counter() - start
+    result = {'requests': args.clients * args.requests, 'errors': len(errors),
+              'requests_per_sec': len(latencies) / elapsed if elapsed else 0}
+    result.update(percentiles(latencies))
+    return result
+
+
+async def run_benchmark(args) -> dict:
+    command = [sys.executable, os.path.abspath(__file__), '--serve', '--devices', str(args.devices),
+               '--ssdp-port', str(args.ssdp_port)]
+    if args.http_port is not None:
+        command += ['--http-port', str(args.http_port)]
+    if args.ssdp_limits:
+        command.append('--ssdp-limits')
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, cwd=os.path.dirname(os.path.abspath(__file__)))
+    try:
+        urls = json.loads(server.stdout.readline())['setup_urls']
+        report = {'devices': args.devices, 'mode': 'single-port' if args.http_port is not None else 'per-port',
+                  'server_idle': process_stats(server.pid)}
+        if args.searches:
+            report['ssdp'] = await flood_searches(args)
+        if args.clients and args.requests:
+            report['http'] = await drive_http(args, urls)
+        report['server'] = process_stats(server.pid)
+        return report
+    finally:
+        server.kill()
+        server.wait()
+
+
+def simulate(args) -> dict:
+    """Pulse each device in turn, then all of them at once, `args.simulate` times over in virtual time."""
+    import testRPiGPIO
+    clock = testRPiGPIO.use_clock(testRPiGPIO.VirtualClock())
+    import fauxmo
+    if fauxmo.GPIO is not testRPiGPIO:
+        raise SystemExit('--simulate needs the testRPiGPIO backend, but RPi.GPIO is installed')
+
+    pins = [100 + i for i in range(args.devices)]
+    switches = [fauxmo.GPIOOneShot(pin) for pin in pins]
+    macro = fauxmo.GPIOAllOff(pins)
+    width = fauxmo.PULSE_WIDTH
+    step = width * 1.5
+    macro_starts = set()
+    start = time.perf_counter()
+    for _ in range(args.simulate):
+        for switch in switches:
+            switch.on()
+            testRPiGPIO.advance(step, [fauxmo.PULSES])
+        macro_starts.add(clock())
+        macro.off()
+        testRPiGPIO.advance(step, [fauxmo.PULSES])
+    elapsed = time.perf_counter() - start
+
+    widths = [pulse_width for pin in pins for _, pulse_width in testRPiGPIO.pulses(pin)]
+    overlaps = [overlap for overlap in testRPiGPIO.overlaps(pins) if overlap[0] not in macro_starts]
+    return {'devices': args.devices, 'mode': 'simulated', 'rounds': args.simulate, 'pulses': len(widths),
+            'expected_pulses': args.simulate * len(pins) * 2,
+            'bad_widths': sum(1 for pulse_width in widths if abs(pulse_width - width) > 1e-6),
+            'unexpected_overlaps': len(overlaps), 'simulated_seconds': clock(), 'wall_seconds': elapsed,
+            'speedup': clock() / elapsed if elapsed else None}
+
+
+def free_udp_port() -> int:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Benchmark fauxmo discovery and control on loopback")
+    parser.add_argument('--devices', type=int, default=14, help="number of emulated devices")
+    parser.add_argument('--searches', type=int, default=200, help="total M-SEARCH datagrams to send")
+    parser.add_argument('--senders', type=int, default=8, help="distinct sockets sending searches")
+    parser.add_argument('--mx', type=int, default=0, help="MX value sent with each search")
+    parser.add_argument('--clients', type=int, default=8, help="concurrent HTTP clients")
+    parser.add_argument('--requests', type=int, default=200, help="requests per HTTP client")
+    parser.add_argument('--keep-alive', action='store_true', help="reuse HTTP connections")
+    parser.add_argument('--http-port', type=int, default=None, help="benchmark single-port mode on this port")
+    parser.add_argument('--ssdp-port', type=int, default=None, help="UDP port for the server's SSDP listener")
+    parser.add_argument('--ssdp-limits', action='store_true',
+                        help="keep the server's default search rate limits instead of lifting them")
+    parser.add_argument('--simulate', type=int, default=0, metavar='ROUNDS',
+                        help="run this many rounds of pulses on a virtual clock instead of serving")
+    parser.add_argument('--output', default=None, help="also write the JSON report to this file")
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        try:
+            asyncio.run(run_server(args))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    if args.simulate:
+        report = simulate(args)
+    else:
+        if args.ssdp_port is None:
+            args.ssdp_port = free_udp_port()
+        report = asyncio.run(run_benchmark(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+"""
+capture.py :: Compact binary recording of SSDP and HTTP traffic, for replay.py.
+"""
+import asyncio
+import socket
+import struct
+import time
+
+MAGIC = b'FXC1'
+HEADER = struct.Struct('<4sd')          # magic, wall-clock time capture started
+RECORD = struct.Struct('<dIB4sHHI')     # seconds since start, stream, kind, peer address, peer port,
+                                        # local port, payload length
+
+# Record kinds. Datagrams all belong to stream 0; each TCP connection gets
+# a stream of its own.
+SEARCH = 1      # datagram received by the SSDP responder
+REPLY = 2       # search reply sent to a peer
+OPEN = 3        # client connected to a device
+DATA = 4        # bytes received from a client
+SENT = 5        # bytes written to a client
+CLOSE = 6       # client connection closed
+
+KIND_NAMES = {SEARCH: 'search', REPLY: 'reply', OPEN: 'open', DATA: 'data', SENT: 'sent', CLOSE: 'close'}
+
+
+class Capture(object):
+    """Append timestamped traffic records to a file.
+
+    Each record is a fixed 25-byte header followed by its payload, written
+    through an ordinary buffered file so recording costs a struct pack and
+    a memory copy. Timestamps come from the monotonic clock, relative to
+    when the capture was opened.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.start = time.monotonic()
+        self.next_stream = 1
+        self.records = 0
+        self._file = open(path, 'wb')
+        self._file.write(HEADER.pack(MAGIC, time.time()))
+
+    def stream(self) -> int:
+        """A new stream number for one TCP connection."""
+        stream = self.next_stream
+        self.next_stream += 1
+        return stream
+
+    def record(self, kind: int, stream: int, peer, local_port: int, data: bytes = b'') -> None:
+        try:
+            address = socket.inet_aton(peer[0])
+        except OSError:
+            address = b'\0\0\0\0'
+        self._file.write(RECORD.pack(time.monotonic() - self.start, stream, kind, address, peer[1], local_port,
+                                     len(data)))
+        if data:
+            self._file.write(data)
+        self.records += 1
+
+    def flush(self) -> None:
+        self._file.flush()
+
+    async def maintain(self, interval: float = 1) -> None:
+        """Flush to disk every `interval` seconds."""
+        while True:
+            await asyncio.sleep(interval)
+            self.flush()
+
+    def close(self) -> None:
+        self._file.close()
+
+
+def read_capture(path: str):
+    """Yield `(stamp, stream, kind, (address, port), local_port, payload)` for every record in `path`."""
+    with open(path, 'rb') as capture:
+        data = capture.read()
+    magic, started = HEADER.unpack_from(data, 0)
+    if magic != MAGIC:
+        raise Exception('%s is not a fauxmo capture' % path)
+    offset = HEADER.size
+    while offset + RECORD.size <= len(data):
+        stamp, stream, kind, address, port, local_port, length = RECORD.unpack_from(data, offset)
+        offset += RECORD.size
+        yield stamp, stream, kind, (socket.inet_ntoa(address), port), local_port, data[offset:offset + length]
+        offset += length
@@ -0,0 +1,145 @@
+"""
+conflicts.py :: Mutual exclusion between devices that must never act together.
+"""
+import asyncio
+import collections
+
+
+class ConflictGroup(object):
+    """Devices that share one piece of equipment, such as a thermostat.
+
+    Whenever one of them acts it holds the group until its action has
+    finished and `gap` more seconds have passed, so that the equipment sees
+    distinct presses. A device that wants to act while the group is held
+    either waits its turn, in arrival order, or (with `preempt`) cuts the
+    pulse in flight short and takes over at once.
+    """
+
+    def __init__(self, names, gap: float, preempt: bool = False) -> None:
+        """Initialize a ConflictGroup.
+        Args:
+            names: Names of the devices in the group
+            gap: Seconds the group stays held after its holder has finished
+            preempt: Cancel the pulse in flight instead of queueing behind it
+        """
+        self.names = tuple(names)
+        self.gap = gap
+        self.preempt = preempt
+        self.holder = None
+        self.cancel_holder = None
+        self.waiters = collections.deque()
+        self._timer = None
+
+    def busy(self) -> bool:
+        return self.holder is not None
+
+    def acquire(self, name, cancel=None):
+        """Take the group for `name`, who must `release` it when done.
+        Args:
+            name: Device that wants to act
+            cancel: Optional callable that ends this device's pulse early,
+                    used if a later device preempts it
+        Returns:
+            None if the group was taken straight away, otherwise a future
+            that resolves once it has been taken for `name`
+        """
+        if self.holder is not None and self.preempt:
+            if self.cancel_holder is not None:
+                self.cancel_holder()
+            self._release()
+        if self.holder is None and not self.waiters:
+            self._take(name, cancel)
+            return None
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append((name, cancel, waiter))
+        return waiter
+
+    def release(self, name) -> None:
+        """Hand the group on `gap` seconds from now, if `name` still holds it."""
+        if self.holder != name or self._timer is not None:
+            return
+        self.cancel_holder = None
+        self._timer = asyncio.get_running_loop().call_later(self.gap, self._next)
+
+    def _take(self, name, cancel) -> None:
+        self.holder = name
+        self.cancel_holder = cancel
+
+    def _release(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self.holder = None
+        self.cancel_holder = None
+
+    def _next(self) -> None:
+        self._timer = None
+        self._release()
+        while self.waiters:
+            name, cancel, waiter = self.waiters.popleft()
+            if waiter.done():
+                continue
+            self._take(name, cancel)
+            waiter.set_result(True)
+            return
+
+
+class ConflictIndex(object):
+    """Every conflict group, indexed by device name and by pin for O(1) lookup.
+
+    A group is named by its devices, but it also owns every pin they drive:
+    any other device that drives one of those pins, such as a reset that
+    pulses all of them, has to take the group as well.
+    """
+
+    def __init__(self, groups=(), gap: float = 0.5, device_pins=None, previous=None) -> None:
+        """Initialize a ConflictIndex.
+        Args:
+            groups: Iterable of groups, each either a list of device names
+                    or a dict with "devices" and optionally "preempt"
+            gap: Seconds a group stays held after its holder has finished
+            device_pins: Optional dict of device name to the pins it drives
+            previous: Optional ConflictIndex this one replaces. Its groups
+                      with the same devices and preempt are kept, along
+                      with whoever holds them or waits for them.
+        """
+        device_pins = device_pins or {}
+        kept = {}
+        if previous is not None:
+            kept = {(group.names, group.preempt): group for group in previous.groups}
+        self.groups = []
+        self.index = {}
+        self.pins = {}
+        for group in groups:
+            preempt = False
+            if isinstance(group, dict):
+                preempt = bool(group.get('preempt', False))
+                group = group.get('devices', [])
+            names = [name for name in group if name]
+            if len(names) < 2:
+                continue
+            conflict_group = kept.pop((tuple(names), preempt), None)
+            if conflict_group is None:
+                conflict_group = ConflictGroup(names, gap, preempt)
+            conflict_group.gap = gap
+            for name in names:
+                if name in self.index:
+                    raise Exception('Device %s is in more than one conflict group' % name)
+                self.index[name] = conflict_group
+                for pin in device_pins.get(name, ()):
+                    if self.pins.setdefault(pin, conflict_group) is not conflict_group:
+                        raise Exception('Pin %s is driven by devices in more than one conflict group' % pin)
+            self.groups.append(conflict_group)
+
+    def group(self, name):
+        """The group `name` is named in, or None."""
+        return self.index.get(name)
+
+    def groups_for(self, name, pins=()) -> tuple:
+        """Every group `name` has to take: the one it is named in, and any
+        that owns one of `pins`, in the order the groups were given."""
+        found = {self.pins[pin] for pin in pins if pin in self.pins}
+        named = self.index.get(name)
+        if named is not None:
+            found.add(named)
+        return tuple(group for group in self.groups if group in found)
@@ -0,0 +1,160 @@
+"""
+eventlog.py :: Event logger writing fixed-size records into a ring buffer.
+"""
+import atexit
+import os
+import struct
+import sys
+import threading
+import time
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+RECORD_HEADER = struct.Struct('<dHBx')  # wall-clock time, message length, level
+
+
+class RingLog(object):
+    """Log events into a preallocated ring and write them out in the background.
+
+    Logging an event below `level` is one comparison. Otherwise the message
+    is formatted, truncated to fit a fixed-size record and copied into the
+    ring; nothing is written to the output on the caller's thread. A drain
+    thread wakes every `interval` seconds and writes everything new in one
+    batch. If the output falls behind by more than the ring holds, the
+    oldest events are dropped and counted rather than blocking the caller.
+    """
+
+    def __init__(self, capacity: int = 4096, record_size: int = 256, level: int = INFO, output=None,
+                 interval: float = 0.1) -> None:
+        """Initialize a RingLog.
+        Args:
+            capacity: Number of events the ring holds
+            record_size: Bytes per event, header included; longer messages
+                         are truncated
+            level: Events below this level are discarded
+            output: Binary file the drain writes to; defaults to stdout
+            interval: Seconds between drains
+        """
+        self.capacity = capacity
+        self.record_size = record_size
+        self.max_message = record_size - RECORD_HEADER.size
+        self.level = level
+        self.output = output
+        self.interval = interval
+        self.ring = bytearray(capacity * record_size)
+        self.head = 0
+        self.tail = 0
+        self.dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        atexit.register(self.drain)
+        if hasattr(os, 'register_at_fork'):
+            os.register_at_fork(after_in_child=self._forked)
+
+    def enabled(self, level: int) -> bool:
+        return level >= self.level
+
+    def log(self, level: int, msg, *args) -> None:
+        """Record `msg` (formatted with `args`, if any) at `level`."""
+        if level < self.level:
+            return
+        if args:
+            msg = msg % args
+        if not isinstance(msg, bytes):
+            msg = str(msg).encode('utf-8', 'replace')
+        msg = msg[:self.max_message]
+        offset = (self.head % self.capacity) * self.record_size
+        RECORD_HEADER.pack_into(self.ring, offset, time.time(), len(msg), level)
+        start = offset + RECORD_HEADER.size
+        self.ring[start:start + len(msg)] = msg
+        self.head += 1
+
+    def debug(self, msg, *args) -> None:
+        self.log(DEBUG, msg, *args)
+
+    def info(self, msg, *args) -> None:
+        self.log(INFO, msg, *args)
+
+    def warning(self, msg, *args) -> None:
+        self.log(WARNING, msg, *args)
+
+    def error(self, msg, *args) -> None:
+        self.log(ERROR, msg, *args)
+
+    def _format(self, seq: int) -> bytes:
+        offset = (seq % self.capacity) * self.record_size
+        stamp, length, level = RECORD_HEADER.unpack_from(self.ring, offset)
+        start = offset + RECORD_HEADER.size
+        message = bytes(self.ring[start:start + length])
+        return b'%s.%03d %-7s %s\n' % (time.strftime('%H:%M:%S', time.localtime(stamp)).encode(),
+                                       int(stamp * 1000) % 1000, LEVEL_NAMES.get(level, str(level)).encode(),
+                                       message)
+
+    def _lines(self, first: int, last: int) -> list:
+        lines = []
+        for seq in range(first, last):
+            line = self._format(seq)
+            # The record may have been overwritten while we read it
+            if self.head - seq >= self.capacity:
+                self.dropped += 1
+                continue
+            lines.append(line)
+        return lines
+
+    def _write(self, lines) -> None:
+        output = self.output or sys.stdout.buffer
+        try:
+            output.write(b''.join(lines))
+            output.flush()
+        except (OSError, ValueError):
+            pass
+
+    def drain(self) -> int:
+        """Write every event logged since the last drain. Returns how many were written."""
+        with self._lock:
+            head = self.head
+            tail = self.tail
+            if head - tail > self.capacity:
+                self.dropped += head - tail - self.capacity
+                tail = head - self.capacity
+            lines = self._lines(tail, head)
+            self.tail = head
+            if lines:
+                self._write(lines)
+            return len(lines)
+
+    def dump(self, count: int = 100) -> list:
+        """The last `count` events still in the ring, oldest first, as text lines."""
+        head = self.head
+        first = max(0, head - min(count, self.capacity - 1))
+        return [line.decode('utf-8', 'replace') for line in self._lines(first, head)]
+
+    def write_dump(self, count: int = 100) -> None:
+        """Write the last `count` events to the output straight away."""
+        lines = [b'--- last %d events ---\n' % count]
+        lines.extend(line.encode() for line in self.dump(count))
+        lines.append(b'--- end of events ---\n')
+        with self._lock:
+            self._write(lines)
+
+    def start(self) -> None:
+        """Start the drain thread, if it isn't already running in this process."""
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._thread = threading.Thread(target=self._run, name='eventlog-drain', daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.interval)
+            self.drain()
+
+    def _forked(self) -> None:
+        # The parent drains whatever it had logged; the child starts afresh.
+        self._lock = threading.Lock()
+        self._thread = None
+        self.tail = self.head
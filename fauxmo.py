@@ -22,21 +22,52 @@ THE SOFTWARE.
 
 # For a complete discussion, see http://www.makermusings.com
 
+import time
+
+# Startup phases are timed from here
+STARTED = time.perf_counter()
+
+import abc
+import argparse
+import asyncio
+import collections
+import concurrent.futures
 import email.utils
+import functools
+import importlib.util
+import inspect
+import json
+import multiprocessing
+import multiprocessing.connection
+import os
+import random
+import re
 # import requests
-import select
+import signal
 import socket
 import struct
 import sys
-import time
-# import urllib
+import threading
+import urllib.parse
 import uuid
+import zlib
 
 try:
     import RPi.GPIO as GPIO
 except ImportError:
     import testRPiGPIO as GPIO
 
+import capture
+import eventlog
+import interfaces
+from conflicts import ConflictIndex
+from journal import StateJournal
+from metrics import REGISTRY, monitor_loop_lag, serve_metrics
+from pinbank import PinBank, as_pins
+from pulses import PulseScheduler
+from sharedstate import StateExport
+from timingwheel import TimingWheel
+
 # This XML is the minimum needed to define one of our virtual switches
 # to the Amazon Echo
 
@@ -49,223 +80,1356 @@ SETUP_XML = """<?xml version="1.0"?>
     <modelName>Emulated Socket</modelName>
     <modelNumber>3.1415</modelNumber>
     <UDN>uuid:Socket-1_0-%(device_serial)s</UDN>
-  </device>
+%(service_list)s  </device>
 </root>
 """
 
-DEBUG = False
+# Only advertised in single-port mode, where the control URL has to carry
+# the device's path prefix.
+
+SERVICE_LIST_XML = """    <serviceList>
+      <service>
+        <serviceType>urn:Belkin:service:basicevent:1</serviceType>
+        <serviceId>urn:Belkin:serviceId:basicevent1</serviceId>
+        <controlURL>%(path_prefix)s/upnp/control/basicevent1</controlURL>
+        <eventSubURL>%(path_prefix)s/upnp/event/basicevent1</eventSubURL>
+      </service>
+    </serviceList>
+"""
+
+# SOAP body answering GetBinaryState, and the property set pushed to
+# event subscribers when the state changes.
+
+BINARY_STATE_SOAP = """<s:Envelope xmlns:s="http://schemas.xmlsoap.org/soap/envelope/" \
+s:encodingStyle="http://schemas.xmlsoap.org/soap/encoding/"><s:Body>\
+<u:GetBinaryStateResponse xmlns:u="urn:Belkin:service:basicevent:1">\
+<BinaryState>%(state)d</BinaryState>\
+</u:GetBinaryStateResponse></s:Body></s:Envelope>"""
 
+BINARY_STATE_EVENT = """<e:propertyset xmlns:e="urn:schemas-upnp-org:event-1-0">\
+<e:property><BinaryState>%(state)d</BinaryState></e:property>\
+</e:propertyset>"""
 
-def dbg(msg):
-    global DEBUG
-    if DEBUG:
-        print(msg)
-        sys.stdout.flush()
+# With --persona hue, every device is presented as a light behind one
+# emulated Hue bridge. This is the bridge's description document.
 
+HUE_DESCRIPTION_XML = """<?xml version="1.0" encoding="UTF-8" ?>
+<root xmlns="urn:schemas-upnp-org:device-1-0">
+  <specVersion><major>1</major><minor>0</minor></specVersion>
+  <URLBase>http://%(ip_address)s:%(port)s/</URLBase>
+  <device>
+    <deviceType>urn:schemas-upnp-org:device:Basic:1</deviceType>
+    <friendlyName>Philips hue (%(ip_address)s)</friendlyName>
+    <manufacturer>Royal Philips Electronics</manufacturer>
+    <manufacturerURL>http://www.philips.com</manufacturerURL>
+    <modelDescription>Philips hue Personal Wireless Lighting</modelDescription>
+    <modelName>Philips hue bridge 2015</modelName>
+    <modelNumber>BSB002</modelNumber>
+    <modelURL>http://www.meethue.com</modelURL>
+    <serialNumber>%(serial)s</serialNumber>
+    <UDN>uuid:%(uuid)s</UDN>
+  </device>
+</root>
+"""
 
-# A simple utility class to wait for incoming data to be
-# ready on a socket.
+# Event subscriptions that don't ask for a timeout last this many seconds
+SUBSCRIPTION_TIMEOUT = 1800
+
+# Every message goes through this logger, which keeps recent events in a
+# ring buffer and writes them out from a background thread. -d lowers its
+# level to DEBUG; SIGUSR1 dumps the last DUMP_EVENTS events.
+LOG = eventlog.RingLog()
+DUMP_EVENTS = 200
+
+# Client connections are closed after this many seconds without a request,
+# and no more than this many are kept open, in all and per listening socket.
+# Anything over the limits is turned away with a 503.
+IDLE_TIMEOUT = 60
+MAX_CONNECTIONS = 256
+MAX_DEVICE_CONNECTIONS = 16
+
+# Pending connections the kernel queues for each listening socket, enough
+# for every Echo in the house to discover every device at once
+LISTEN_BACKLOG = 128
+
+# Stop reading from a client while more than this many bytes of responses
+# are waiting to be sent to it
+WRITE_BUFFER_HIGH = 64 * 1024
+
+# Every device state change is recorded in this journal (see --state-file),
+# and each device starts from its last recorded state. None when disabled.
+JOURNAL = None
+
+# Inbound datagrams and TCP payloads, and what was sent back, are recorded
+# here (see --capture) for replay.py to play back. None when disabled.
+CAPTURE = None
+
+# Each device's state and command counts are published here (see
+# --state-export) for other local processes to read with sharedstate.py.
+# None when disabled.
+STATES = None
+
+# How often, in seconds, the config file is checked for changes
+RELOAD_INTERVAL = 2
+
+# Set when the device list is sharded across worker processes, so that a
+# restarted worker can rebind its ports while its predecessor's sockets are
+# still being torn down.
+REUSE_PORT = False
+
+# With several workers, the worker holding the multicast membership forwards
+# each search to the others on 127.0.0.1, at FANOUT_PORT + worker index.
+FANOUT_PORT = 58400
+FORWARD_HEADER = b'FAUXMO-FORWARD %s %d\r\n'
+
+# How often, in seconds, a worker checks that its supervisor is still there
+SUPERVISOR_CHECK = 1
+
+# The only search the Echo sends for WeMo devices
+SEARCH_TARGET = 'urn:Belkin:device:**'
+
+# The searches an emulated Hue bridge answers. A search for everything is
+# answered as one for the bridge's device type.
+HUE_SEARCH_TARGET = 'urn:schemas-upnp-org:device:basic:1'
+HUE_SEARCH_TARGETS = (HUE_SEARCH_TARGET, 'upnp:rootdevice', 'ssdp:all')
+SEARCH_TARGETS = frozenset((SEARCH_TARGET,) + HUE_SEARCH_TARGETS)
+ST_RE = re.compile(br'^ST:[ \t]*(\S+)', re.MULTILINE | re.IGNORECASE)
+
+# The Echo only talks to a Hue bridge on the standard HTTP port
+HUE_PORT = 80
+HUE_SERVER = 'Linux/3.14.0 UPnP/1.0 IpBridge/1.24.0'
+
+# Replies to a search are spread over its MX window (in seconds), which
+# UPnP caps at 5. Searches that don't say are answered within a second.
+MX_DEFAULT = 1
+MX_MAX = 5
+MX_RE = re.compile(br'^MX:[ \t]*(\d+)', re.MULTILINE | re.IGNORECASE)
+
+# Searches are rate limited per sending host with a token bucket holding
+# SSDP_BURST searches and refilled at SSDP_RATE per second. A search from the
+# same address and port for the same target within SSDP_SUPPRESS seconds of
+# one that was answered is dropped.
+SSDP_RATE = 2
+SSDP_BURST = 10
+SSDP_SUPPRESS = 2
+
+# Action handlers whose on()/off() may block run in a pool of this many
+# threads. Every action, in a thread or a coroutine, is given up on after
+# ACTION_TIMEOUT seconds, and a device never has more than
+# MAX_DEVICE_ACTIONS of them still running in the pool.
+ACTION_THREADS = 4
+ACTION_TIMEOUT = 10
+MAX_DEVICE_ACTIONS = 2
+
+# How long a one-shot output is held before it is released again.
+PULSE_WIDTH = 2
+
+# Pulses on the same pin, and devices in the same conflict group, are kept
+# apart by at least this much more than a pulse, so the equipment they
+# drive sees distinct presses.
+CONFLICT_GAP = 0.5
+
+# The conflict group that owns each pin, if any (see ConflictIndex). A device
+# driving several pins of one group pulses them one at a time.
+CONFLICT_PINS = {}
+
+# A command identical to the one a device last ran within this many seconds
+# (e.g. several Echos hearing the same utterance, or a retry) is answered
+# without running it again.
+COALESCE_WINDOW = 3
+
+# Every output pin is set up once in this bank, which also caches its state.
+BANK = PinBank(GPIO, GPIO.BCM)
+
+# One-shot outputs are released by this scheduler rather than by sleeping
+# in the request handler. The simulated GPIO backend brings its own clock,
+# which may be virtual.
+PULSES = PulseScheduler(BANK.output, clock=getattr(GPIO, 'clock', time.monotonic))
+
+# Always-on metrics, served with --metrics-port. Per-device metrics are
+# created alongside each device.
+SSDP_SEARCHES = REGISTRY.counter('fauxmo_ssdp_searches_total', "M-SEARCH requests scheduled for a reply")
+SSDP_SEARCH_SECONDS = REGISTRY.histogram('fauxmo_ssdp_search_seconds', "Time spent handling one M-SEARCH")
+SSDP_REPLY_SECONDS = REGISTRY.histogram('fauxmo_ssdp_reply_seconds', "Time spent sending one device's reply")
+SSDP_RATE_LIMITED = REGISTRY.counter('fauxmo_ssdp_dropped_total', "M-SEARCH requests not answered",
+                                     reason='rate_limited')
+SSDP_SUPPRESSED = REGISTRY.counter('fauxmo_ssdp_dropped_total', "M-SEARCH requests not answered",
+                                   reason='suppressed')
+SSDP_COALESCED = REGISTRY.counter('fauxmo_ssdp_dropped_total', "M-SEARCH requests not answered",
+                                  reason='coalesced')
+LOOP_LAG_SECONDS = REGISTRY.histogram('fauxmo_loop_lag_seconds', "How late the event loop runs a timer")
+CONNECTIONS_REFUSED = REGISTRY.counter('fauxmo_connections_refused_total', "Connections over the connection limits")
+CONNECTIONS_TIMED_OUT = REGISTRY.counter('fauxmo_connections_timed_out_total', "Connections closed for being idle")
+
+
+def dbg(msg, *args):
+    LOG.log(eventlog.DEBUG, msg, *args)
+
+
+# The DATE header only changes once a second, so the formatted value is
+# shared by every response built within the same second.
+
+class HTTPDate(object):
+    second = None
+    value = b''
+
+    @classmethod
+    def now(cls):
+        second = int(time.time())
+        if second != cls.second:
+            cls.second = second
+            cls.value = email.utils.formatdate(timeval=second, localtime=False, usegmt=True).encode()
+        return cls.value
+
+
+# A prebuilt response whose only varying part is its DATE header. Everything
+# either side of the date is encoded once, and the complete buffer is
+# rebuilt at most once a second; otherwise the same bytes are sent again.
+# A keep-alive variant is kept alongside for clients that reuse connections.
+
+class CachedResponse(object):
+    def __init__(self, head, tail):
+        self.head = head.encode()
+        self.tails = (tail.encode(), tail.replace("CONNECTION: close", "CONNECTION: keep-alive").encode())
+        self.second = None
+        self.data = (b'', b'')
+
+    def get(self, keep_alive=False):
+        date = HTTPDate.now()
+        if self.second != HTTPDate.second:
+            self.second = HTTPDate.second
+            self.data = (self.head + date + self.tails[0], self.head + date + self.tails[1])
+        return self.data[keep_alive]
+
+
+def error_response(status):
+    return CachedResponse("HTTP/1.1 %s\r\n"
+                          "CONTENT-LENGTH: 0\r\n"
+                          "DATE: " % status,
+                          "\r\n"
+                          "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                          "CONNECTION: close\r\n"
+                          "\r\n")
+
+
+HTTP_ERRORS = {
+    400: error_response("400 Bad Request"),
+    404: error_response("404 Not Found"),
+    413: error_response("413 Payload Too Large"),
+    431: error_response("431 Request Header Fields Too Large"),
+    500: error_response("500 Internal Server Error"),
+    501: error_response("501 Not Implemented"),
+    503: error_response("503 Service Unavailable"),
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, reason):
+        Exception.__init__(self, reason)
+        self.status = status
+
+
+# One request off the wire. Method, path and header values are left as
+# bytes; header names are lower-cased.
+
+class HTTPRequest(object):
+    __slots__ = ('method', 'path', 'version', 'headers', 'body')
+
+    def __init__(self, method, path, version, headers):
+        self.method = method
+        self.path = path
+        self.version = version
+        self.headers = headers
+        self.body = b''
+
+    @property
+    def keep_alive(self):
+        connection = self.headers.get(b'connection', b'').lower()
+        if self.version == b'HTTP/1.1':
+            return connection != b'close'
+        return connection == b'keep-alive'
+
+
+# Incremental request parser for one connection. Received data is appended
+# to a buffer and complete requests are cut out of it as soon as their
+# headers and Content-Length bytes of body have arrived, so requests split
+# across segments are reassembled and pipelined requests are all returned.
+# The header terminator search resumes where the last one left off rather
+# than rescanning the whole buffer.
+
+class HTTPRequestParser(object):
+    MAX_HEADER_SIZE = 8192
+    MAX_BODY_SIZE = 65536
 
-class Poller:
     def __init__(self):
-        if 'poll' in dir(select):
-            self.use_poll = True
-            self.poller = select.poll()
-        else:
-            self.use_poll = False
-        self.targets = {}
+        self.buffer = bytearray()
+        self.scanned = 0
+        self.request = None
+        self.body_length = 0
+
+    def feed(self, data):
+        buffer = self.buffer
+        buffer += data
+        requests = []
+        pos = 0
+        while True:
+            if self.request is None:
+                # Tolerate stray CRLFs between pipelined requests
+                while buffer.startswith(b'\r\n', pos):
+                    pos += 2
+                end = buffer.find(b'\r\n\r\n', max(pos, self.scanned - 3))
+                if end == -1:
+                    self.scanned = len(buffer)
+                    if self.scanned - pos > self.MAX_HEADER_SIZE:
+                        raise HTTPError(431, "request headers too large")
+                    break
+                self.request = self.parse_head(bytes(buffer[pos:end]))
+                pos = self.scanned = end + 4
+            if len(buffer) - pos < self.body_length:
+                break
+            if self.body_length:
+                with memoryview(buffer) as view:
+                    self.request.body = bytes(view[pos:pos + self.body_length])
+                pos = self.scanned = pos + self.body_length
+            requests.append(self.request)
+            self.request = None
+            self.body_length = 0
+        if pos:
+            del buffer[:pos]
+            self.scanned -= pos
+        return requests
+
+    def parse_head(self, head):
+        lines = head.split(b'\r\n')
+        request_line = lines[0].split(b' ')
+        if len(request_line) != 3:
+            raise HTTPError(400, "malformed request line")
+        headers = {}
+        for line in lines[1:]:
+            name, sep, value = line.partition(b':')
+            if not sep:
+                raise HTTPError(400, "malformed header line")
+            headers[name.strip().lower()] = value.strip()
+        if b'transfer-encoding' in headers:
+            raise HTTPError(501, "transfer encodings are not supported")
+        try:
+            self.body_length = int(headers.get(b'content-length', 0))
+        except ValueError:
+            raise HTTPError(400, "bad content-length")
+        if self.body_length < 0:
+            raise HTTPError(400, "bad content-length")
+        if self.body_length > self.MAX_BODY_SIZE:
+            raise HTTPError(413, "request body too large")
+        return HTTPRequest(request_line[0], request_line[1], request_line[2], headers)
+
+
+# Keeps count of open client connections, turns away any over the limits and
+# closes those that sit idle. Idle connections are found with a timing
+# wheel, so a request costs one bucket move however many connections are
+# open.
+
+class ConnectionManager(object):
+    def __init__(self):
+        self.open = 0
+        self.configure()
+
+    def configure(self, idle_timeout=IDLE_TIMEOUT, max_connections=MAX_CONNECTIONS,
+                  max_device_connections=MAX_DEVICE_CONNECTIONS):
+        self.max_connections = max_connections
+        self.max_device_connections = max_device_connections
+        self.idle = TimingWheel(idle_timeout, self.expire)
+
+    def admit(self, protocol):
+        if self.open >= self.max_connections or \
+                len(protocol.device.client_sockets) >= self.max_device_connections:
+            CONNECTIONS_REFUSED.inc()
+            return False
+        self.open += 1
+        self.idle.touch(protocol)
+        return True
 
-    def add(self, target, fileno=None):
-        if not fileno:
-            fileno = target.fileno()
-        if self.use_poll:
-            self.poller.register(fileno, select.POLLIN)
-        self.targets[fileno] = target
-
-    def remove(self, target, fileno=None):
-        if not fileno:
-            fileno = target.fileno()
-        if self.use_poll:
-            self.poller.unregister(fileno)
-        del (self.targets[fileno])
-
-    def poll(self, timeout=0):
-        if self.use_poll:
-            ready = self.poller.poll(timeout)
-        else:
-            ready = []
-            if len(self.targets) > 0:
-                (rlist, wlist, xlist) = select.select(self.targets.keys(), [], [], timeout)
-                ready = [(x, None) for x in rlist]
-        for one_ready in ready:
-            target = self.targets.get(one_ready[0], None)
-            if target:
-                target.do_read(one_ready[0])
+    def release(self, protocol):
+        self.open -= 1
+        self.idle.discard(protocol)
+
+    def expire(self, protocol):
+        if protocol.responses:
+            # Still waiting on an action to answer; not idle
+            self.idle.touch(protocol)
+            return
+        dbg("Closing idle connection from %s:%s", protocol.sender[0], protocol.sender[1])
+        CONNECTIONS_TIMED_OUT.inc()
+        protocol.transport.close()
+
+
+CONNECTIONS = ConnectionManager()
+
+
+# Connection handler for one client of a UPnPDevice. Requests are parsed
+# as they arrive and answered in order; the connection is closed after any
+# request that doesn't ask for keep-alive. A device may answer with a
+# future instead of a response, in which case later responses on the same
+# connection wait for it. Writes are buffered by the transport; if a client
+# stops reading, we stop reading from it too until its buffer drains.
+
+class UPnPDeviceProtocol(asyncio.Protocol):
+    def __init__(self, device):
+        self.device = device
+        self.transport = None
+        self.sender = None
+        self.parser = HTTPRequestParser()
+        self.responses = collections.deque()
+        self.admitted = False
+        self.stream = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.sender = transport.get_extra_info('peername')
+        if CAPTURE is not None:
+            self.stream = CAPTURE.stream()
+            CAPTURE.record(capture.OPEN, self.stream, self.sender, self.device.port)
+        if not CONNECTIONS.admit(self):
+            dbg("Refusing connection from %s:%s, too many open", self.sender[0], self.sender[1])
+            self.write(HTTP_ERRORS[503].get())
+            transport.close()
+            return
+        self.admitted = True
+        transport.set_write_buffer_limits(high=WRITE_BUFFER_HIGH)
+        self.device.client_sockets.add(transport)
+
+    def connection_lost(self, exc):
+        if CAPTURE is not None:
+            CAPTURE.record(capture.CLOSE, self.stream, self.sender, self.device.port)
+        if self.admitted:
+            self.device.client_sockets.discard(self.transport)
+            CONNECTIONS.release(self)
+
+    def pause_writing(self):
+        self.transport.pause_reading()
+
+    def resume_writing(self):
+        self.transport.resume_reading()
+
+    def write(self, data):
+        if CAPTURE is not None:
+            CAPTURE.record(capture.SENT, self.stream, self.sender, self.device.port, data)
+        self.transport.write(data)
+
+    def data_received(self, data):
+        if CAPTURE is not None:
+            CAPTURE.record(capture.DATA, self.stream, self.sender, self.device.port, data)
+        CONNECTIONS.idle.touch(self)
+        try:
+            requests = self.parser.feed(data)
+        except HTTPError as err:
+            dbg("Bad request from %s:%s: %s", self.sender[0], self.sender[1], err)
+            self.write(HTTP_ERRORS[err.status].get())
+            self.transport.close()
+            return
+        for request in requests:
+            response = self.device.handle_request(request, self.sender)
+            keep_alive = request.keep_alive
+            if self.responses or isinstance(response, asyncio.Future):
+                self.responses.append((response, keep_alive))
+                self.flush()
+            else:
+                self.write(response.get(keep_alive))
+            if not keep_alive:
+                if not self.responses:
+                    self.transport.close()
+                return
+
+    def flush(self, future=None):
+        while self.responses and not self.transport.is_closing():
+            response, keep_alive = self.responses[0]
+            if isinstance(response, asyncio.Future):
+                if not response.done():
+                    if future is not response:
+                        response.add_done_callback(self.flush)
+                    return
+                response = response.result()
+            self.responses.popleft()
+            self.write(response.get(keep_alive))
+            if not keep_alive:
+                self.responses.clear()
+                self.transport.close()
+
+
+# Normalise an ip_address argument (one address, a list of them, or None for
+# this host's own address) to a list of addresses.
+
+def as_addresses(ip_address):
+    if not ip_address:
+        return [UPnPDevice.local_ip_address()]
+    if isinstance(ip_address, str):
+        return [ip_address]
+    return list(ip_address)
+
+
+# One listening socket for each of `addresses`, all on the same port (the
+# first free one when port is 0), so that a device is served on exactly the
+# interfaces it was given and nowhere else. Each socket may rebind a port
+# whose old connections are still in TIME_WAIT, as after a config reload or
+# restart. Returns the sockets and the port.
+
+def listen_sockets(addresses, port):
+    sockets = []
+    try:
+        for address in addresses:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sockets.append(sock)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if REUSE_PORT:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            sock.bind((address, port))
+            sock.listen(LISTEN_BACKLOG)
+            port = sock.getsockname()[1]
+    except OSError:
+        for sock in sockets:
+            sock.close()
+        raise
+    return sockets, port
+
+
+# Serve connections to `target` on every one of `sockets`.
+
+async def serve_sockets(target, sockets):
+    loop = asyncio.get_running_loop()
+    return [await loop.create_server(lambda: UPnPDeviceProtocol(target), sock=sock, backlog=LISTEN_BACKLOG)
+            for sock in sockets]
 
 
 # Base class for a generic UPnP device. This is far from complete
 # but it supports either specified or automatic IP address and port
-# selection.
+# selection. A device may be reachable on several addresses, one per
+# interface; its search replies point at whichever one the search came in on.
 
 class UPnPDevice(object):
     this_host_ip = None
+    search_targets = ()
 
     @staticmethod
     def local_ip_address():
         if not UPnPDevice.this_host_ip:
-            temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            try:
-                temp_socket.connect(('8.8.8.8', 53))
-                UPnPDevice.this_host_ip = temp_socket.getsockname()[0]
-            except:
-                UPnPDevice.this_host_ip = '127.0.0.1'
-            del temp_socket
+            UPnPDevice.this_host_ip = interfaces.resolve(None)[0].address
             dbg("got local address of %s" % UPnPDevice.this_host_ip)
         return UPnPDevice.this_host_ip
 
-    def __init__(self, listener, poller, port, root_url, server_version, persistent_uuid, other_headers=None,
-                 ip_address=None):
+    def __init__(self, listener, port, root_url, server_version, persistent_uuid, other_headers=None,
+                 ip_address=None, http_server=None, path_prefix=''):
         self.listener = listener
-        self.poller = poller
         self.port = port
         self.root_url = root_url
         self.server_version = server_version
         self.persistent_uuid = persistent_uuid
         self.uuid = uuid.uuid4()
         self.other_headers = other_headers
-
-        if ip_address:
-            self.ip_address = ip_address
+        self.path_prefix = path_prefix
+        self.requested_port = port
+        self.http_server = http_server
+        self.stopped = False
+        self.loop = None
+
+        if http_server:
+            # Single-port mode: the shared listener routes our requests to us
+            self.ip_addresses = http_server.ip_addresses
+            self.ip_address = http_server.ip_address
+            self.port = http_server.port
+            self.sockets = []
+            if not http_server.advertise_devices:
+                # The shared listener answers searches on our behalf
+                self.search_targets = ()
+            http_server.add_device(path_prefix, self)
         else:
-            self.ip_address = UPnPDevice.local_ip_address()
-
-        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.ip_address, self.port))
-        self.socket.listen(5)
-        if self.port == 0:
-            self.port = self.socket.getsockname()[1]
-        self.poller.add(self)
-        self.client_sockets = {}
+            self.ip_addresses = as_addresses(ip_address)
+            self.ip_address = self.ip_addresses[0]
+            self.sockets, self.port = listen_sockets(self.ip_addresses, self.port)
+        self.servers = []
+        self.client_sockets = set()
+        self.search_responses = {}
         self.listener.add_device(self)
 
-    def fileno(self):
-        return self.socket.fileno()
-
-    def do_read(self, fileno):
-        if fileno == self.socket.fileno():
-            (client_socket, client_address) = self.socket.accept()
-            self.poller.add(self, client_socket.fileno())
-            self.client_sockets[client_socket.fileno()] = client_socket
+    # Hand the bound listening sockets over to the event loop. Each accepted
+    # connection gets its own UPnPDeviceProtocol.
+    async def start(self):
+        self.loop = asyncio.get_running_loop()
+        self.servers = await serve_sockets(self, self.sockets)
+
+    # Take the device off the network: stop answering searches, close the
+    # listening socket and drop any open connections.
+    def stop(self):
+        self.stopped = True
+        self.listener.remove_device(self)
+        if self.http_server:
+            self.http_server.remove_device(self.path_prefix)
+        if self.servers:
+            for server in self.servers:
+                server.close()
+            self.servers = []
         else:
-            data, sender = self.client_sockets[fileno].recvfrom(4096)
-            if not data:
-                self.poller.remove(self, fileno)
-                del (self.client_sockets[fileno])
-            else:
-                self.handle_request(data, sender, self.client_sockets[fileno])
+            for sock in self.sockets:
+                sock.close()
+        for transport in list(self.client_sockets):
+            transport.close()
 
-    def handle_request(self, data, sender, socket):
-        pass
+    def handle_request(self, request, sender):
+        return HTTP_ERRORS[404]
 
     def get_name(self):
         return "unknown"
 
-    def respond_to_search(self, destination, search_target):
-        dbg("Responding to search for %s" % self.get_name())
-        date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-        location_url = self.root_url % {'ip_address': self.ip_address, 'port': self.port}
-        message = ("HTTP/1.1 200 OK\r\n"
-                   "CACHE-CONTROL: max-age=86400\r\n"
-                   "DATE: %s\r\n"
-                   "EXT:\r\n"
-                   "LOCATION: %s\r\n"
-                   "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
-                   "01-NLS: %s\r\n"
-                   "SERVER: %s\r\n"
-                   "ST: %s\r\n"
-                   "USN: uuid:%s::%s\r\n" % (
-                       date_str, location_url, self.uuid, self.server_version, search_target, self.persistent_uuid,
-                       search_target))
-        if self.other_headers:
-            for header in self.other_headers:
-                message += "%s\r\n" % header
-        message += "\r\n"
-        temp_socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_socket.sendto(message, destination)
+    # SSDP replies are built once per search target and address, and reused
+    # for every search after that.
+    def search_response(self, search_target, ip_address=None):
+        if ip_address is None:
+            ip_address = self.ip_address
+        response = self.search_responses.get((search_target, ip_address))
+        if response is None:
+            location_url = self.root_url % {'ip_address': ip_address, 'port': self.port,
+                                            'path_prefix': self.path_prefix}
+            head = ("HTTP/1.1 200 OK\r\n"
+                    "CACHE-CONTROL: max-age=86400\r\n"
+                    "DATE: ")
+            tail = ("\r\n"
+                    "EXT:\r\n"
+                    "LOCATION: %s\r\n"
+                    "OPT: \"http://schemas.upnp.org/upnp/1/0/\"; ns=01\r\n"
+                    "01-NLS: %s\r\n"
+                    "SERVER: %s\r\n"
+                    "ST: %s\r\n"
+                    "USN: uuid:%s::%s\r\n" % (
+                        location_url, self.uuid, self.server_version, search_target, self.persistent_uuid,
+                        search_target))
+            if self.other_headers:
+                for header in self.other_headers:
+                    tail += "%s\r\n" % header
+            tail += "\r\n"
+            response = self.search_responses[(search_target, ip_address)] = CachedResponse(head, tail)
+        return response
+
+    def respond_to_search(self, destination, search_target, ip_address=None):
+        dbg("Responding to search for %s", self.get_name())
+        if ip_address not in self.ip_addresses:
+            ip_address = self.ip_address
+        self.listener.sendto(self.search_response(search_target, ip_address).get(), destination)
+
+
+# In single-port mode one listener serves every device. Each device
+# advertises a LOCATION of http://<ip>:<port>/<serial>/setup.xml, and
+# requests are routed on that first path segment with one dict lookup.
+# The prefix is stripped before the request reaches the device, so devices
+# handle requests exactly as they do on a port of their own.
+#
+# Some Echo firmware ignores the advertised control URL and always posts to
+# /upnp/control/basicevent1; use per-port mode for those.
+
+class UPnPHTTPServer(object):
+    advertise_devices = True
+
+    def __init__(self, ip_address, port):
+        self.ip_addresses = as_addresses(ip_address)
+        self.ip_address = self.ip_addresses[0]
+        self.sockets, self.port = listen_sockets(self.ip_addresses, port)
+        self.servers = []
+        self.client_sockets = set()
+        self.routes = {}
+        dbg("Shared HTTP listener ready on %s:%s" % (', '.join(self.ip_addresses), self.port))
+
+    def add_device(self, path_prefix, device):
+        self.routes[path_prefix[1:].encode()] = device
+
+    def remove_device(self, path_prefix):
+        return self.routes.pop(path_prefix[1:].encode(), None)
+
+    # Nothing we serve for one device depends on another device's state
+    def device_state_changed(self, device):
+        pass
+
+    async def start(self):
+        self.servers = await serve_sockets(self, self.sockets)
+
+    def handle_request(self, request, sender):
+        # Paths look like /<serial>/<device path>
+        path = request.path
+        end = path.find(b'/', 1)
+        device = self.routes.get(path[1:end]) if end != -1 else None
+        if device is None:
+            dbg("No device for %s from %s:%s", path.decode(errors='replace'), sender[0], sender[1])
+            return HTTP_ERRORS[404]
+        request.path = path[end:]
+        return device.handle_request(request, sender)
+
+
+def json_response(body):
+    return CachedResponse("HTTP/1.1 200 OK\r\n"
+                          "CONTENT-LENGTH: %d\r\n"
+                          "CONTENT-TYPE: application/json\r\n"
+                          "DATE: " % len(body.encode()),
+                          "\r\n"
+                          "SERVER: %s\r\n"
+                          "CONNECTION: close\r\n"
+                          "\r\n"
+                          "%s" % (HUE_SERVER, body))
+
+
+# The Hue persona: one emulated Hue bridge standing in for every device.
+# The bridge alone answers searches, with a single reply however many
+# devices there are, and the Echo then learns every device from one
+# /api/<user>/lights listing. Each device becomes a light, numbered in the
+# order it was added; the devices themselves stay Fauxmo objects routed
+# through the bridge, so commands go through the same queue, conflict
+# groups and journal as in the WeMo persona.
+#
+# Every response is prebuilt. Per light that is its JSON in either state,
+# its own GET response and the reply to turning it on or off; the listing
+# is joined from the per-light JSON and rebuilt only after a state change.
+# The Echo doesn't insist on pairing, so any user name is accepted.
+
+class HueBridge(UPnPHTTPServer):
+    advertise_devices = False
+    search_targets = HUE_SEARCH_TARGETS
+
+    def __init__(self, listener, ip_address, port=HUE_PORT):
+        UPnPHTTPServer.__init__(self, ip_address, port)
+        self.listener = listener
+        self.stopped = False
+        mac = '%012x' % uuid.getnode()
+        self.serial = mac
+        self.bridge_id = (mac[:6] + 'fffe' + mac[6:]).upper()
+        self.uuid = '2f402f80-da50-11e1-9b23-%s' % mac
+        self.username = uuid.uuid5(uuid.NAMESPACE_DNS, self.bridge_id).hex
+        self.search_responses = {}
+        self.descriptions = {}
+        self.lights = {}
+        self.light_ids = {}
+        self.next_id = 1
+        self.listing = None
+        self.config = None
+        self.register_response = json_response('[{"success": {"username": "%s"}}]' % self.username)
+        listener.advertise(self)
+
+    def add_device(self, path_prefix, device):
+        UPnPHTTPServer.add_device(self, path_prefix, device)
+        light_id = self.next_id
+        self.next_id += 1
+        self.light_ids[device] = light_id
+        crc = zlib.crc32(device.name.encode())
+        unique_id = '00:17:88:01:%02x:%02x:%02x:%02x-0b' % tuple(crc.to_bytes(4, 'big'))
+        light = []
+        for state in (0, 1):
+            light.append(json.dumps({
+                'state': {'on': bool(state), 'bri': 254, 'alert': 'none', 'reachable': True},
+                'type': 'Dimmable light', 'name': device.name, 'modelid': 'LWB004',
+                'manufacturername': 'Philips', 'uniqueid': unique_id, 'swversion': '66012040'}))
+        self.lights[light_id] = {
+            'device': device,
+            'json': light,
+            'responses': [json_response(body) for body in light],
+            'set_responses': [json_response('[{"success": {"/lights/%d/state/on": %s}}]' % (light_id, on))
+                              for on in ('false', 'true')],
+        }
+        self.device_state_changed(device)
+        dbg("Hue bridge: %s is light %d", device.name, light_id)
+
+    def remove_device(self, path_prefix):
+        device = UPnPHTTPServer.remove_device(self, path_prefix)
+        light_id = self.light_ids.pop(device, None)
+        if light_id is not None:
+            del self.lights[light_id]
+            self.device_state_changed(device)
+
+    def device_state_changed(self, device):
+        self.listing = None
+        self.config = None
+
+    def lights_json(self):
+        return '{%s}' % ', '.join('"%d": %s' % (light_id, light['json'][light['device'].state])
+                                  for light_id, light in self.lights.items())
+
+    # Search replies and the description are built once per address the
+    # bridge is reachable on.
+    def search_response(self, search_target, ip_address):
+        if search_target == 'ssdp:all':
+            search_target = HUE_SEARCH_TARGET
+        response = self.search_responses.get((search_target, ip_address))
+        if response is None:
+            response = self.search_responses[(search_target, ip_address)] = CachedResponse(
+                "HTTP/1.1 200 OK\r\n"
+                "CACHE-CONTROL: max-age=100\r\n"
+                "DATE: ",
+                "\r\n"
+                "EXT:\r\n"
+                "LOCATION: http://%s:%s/description.xml\r\n"
+                "SERVER: %s\r\n"
+                "hue-bridgeid: %s\r\n"
+                "ST: %s\r\n"
+                "USN: uuid:%s::%s\r\n"
+                "\r\n" % (ip_address, self.port, HUE_SERVER, self.bridge_id, search_target, self.uuid,
+                            search_target))
+        return response
+
+    def respond_to_search(self, destination, search_target, ip_address=None):
+        dbg("Responding to search for the Hue bridge")
+        if ip_address not in self.ip_addresses:
+            ip_address = self.ip_address
+        self.listener.sendto(self.search_response(search_target, ip_address).get(), destination)
+
+    def description(self, request):
+        # Point the Echo back at whichever of our addresses it asked for
+        host = request.headers.get(b'host', b'').decode(errors='replace').rsplit(':', 1)[0]
+        ip_address = host if host in self.ip_addresses else self.ip_address
+        response = self.descriptions.get(ip_address)
+        if response is None:
+            xml = HUE_DESCRIPTION_XML % {'ip_address': ip_address, 'port': self.port, 'serial': self.serial,
+                                         'uuid': self.uuid}
+            response = self.descriptions[ip_address] = CachedResponse(
+                "HTTP/1.1 200 OK\r\n"
+                "CONTENT-LENGTH: %d\r\n"
+                "CONTENT-TYPE: text/xml\r\n"
+                "DATE: " % len(xml.encode()),
+                "\r\n"
+                "SERVER: %s\r\n"
+                "CONNECTION: close\r\n"
+                "\r\n"
+                "%s" % (HUE_SERVER, xml))
+        return response
+
+    def handle_request(self, request, sender):
+        path = request.path.split(b'?', 1)[0]
+        if path == b'/api' or path.startswith(b'/api/'):
+            return self.handle_api(request, [part for part in path.split(b'/')[2:] if part])
+        if request.method == b'GET' and path == b'/description.xml':
+            dbg("Responding to description.xml for the Hue bridge")
+            return self.description(request)
+        return UPnPHTTPServer.handle_request(self, request, sender)
+
+    # /api paths, after the user name, are: nothing (the whole config),
+    # lights, lights/<id> and lights/<id>/state.
+    def handle_api(self, request, parts):
+        method = request.method
+        if not parts:
+            return self.register_response if method == b'POST' else HTTP_ERRORS[404]
+        parts = parts[1:]
+        if method == b'GET' and not parts:
+            if self.config is None:
+                self.config = json_response('{"lights": %s}' % self.lights_json())
+            return self.config
+        if not parts or parts[0] != b'lights':
+            return HTTP_ERRORS[404]
+        if method == b'GET' and len(parts) == 1:
+            if self.listing is None:
+                self.listing = json_response(self.lights_json())
+            return self.listing
+        try:
+            light = self.lights[int(parts[1])]
+        except (IndexError, ValueError, KeyError):
+            return HTTP_ERRORS[404]
+        if method == b'GET' and len(parts) == 2:
+            return light['responses'][light['device'].state]
+        if method == b'PUT' and parts[2:] == [b'state']:
+            return self.set_light_state(request, light)
+        return HTTP_ERRORS[404]
+
+    def set_light_state(self, request, light):
+        try:
+            body = json.loads(request.body)
+            if 'on' in body:
+                command = 1 if body['on'] else 0
+            else:
+                command = 1 if body['bri'] > 0 else 0
+        except (ValueError, TypeError, KeyError):
+            dbg("Unknown light state request: %r", request.body)
+            return HTTP_ERRORS[400]
+        return light['device'].command_response(command, light['set_responses'][command])
+
+
+# Serialises the commands sent to one device. A command identical to the
+# last one that succeeded, if it finished within the coalescing window, is
+# answered straight away without running again, as is one identical to the
+# command running or waiting. A command that failed or timed out is never
+# coalesced with, so a retry runs. While a command is still running (its
+# action returned an awaitable, or a Pressed that isn't released yet), at
+# most one more waits behind it; a newer command replaces the waiting one.
+# Both senders are told straight away that they succeeded, and `report` is
+# given the result of a waiting command once it has run.
+#
+# submit() returns the action's result when it ran straight away, or True
+# when the command was coalesced or has to wait.
+
+class CommandQueue(object):
+    def __init__(self, execute, window=COALESCE_WINDOW, report=None):
+        self.execute = execute
+        self.window = window
+        self.report = report
+        self.last = None
+        self.last_time = 0
+        self.current = None
+        self.queued = None
+
+    def submit(self, command):
+        if self.queued is not None:
+            if command == self.queued:
+                return True
+            self.queued = None
+            if command == self.current:
+                return True
+        elif command == self.current:
+            return True
+        elif command == self.last and time.monotonic() - self.last_time < self.window:
+            return True
+        if self.current is not None:
+            self.queued = command
+            return True
+        return self.run(command)
+
+    def run(self, command):
+        self.last = None
+        self.current = command
+        result = self.execute(command)
+        if inspect.isawaitable(result):
+            result = asyncio.ensure_future(result)
+            result.add_done_callback(functools.partial(self.finished, command))
+        else:
+            self.ran(command, result)
+        return result
+
+    def finished(self, command, future):
+        self.ran(command, not future.cancelled() and future.exception() is None and future.result())
+
+    # The command is over once its result is in and any pulse it started has
+    # been released; the coalescing window starts from then.
+    def ran(self, command, success):
+        released = getattr(success, 'released', None)
+        if released is not None and not released.done():
+            released.add_done_callback(lambda done: self.ran(command, True))
+            return
+        self.current = None
+        if success:
+            self.last = command
+            self.last_time = time.monotonic()
+        if self.queued is None:
+            return
+        command = self.queued
+        self.queued = None
+        result = self.run(command)
+        if self.report is None:
+            return
+        if isinstance(result, asyncio.Future):
+            result.add_done_callback(
+                lambda done: self.report(not done.cancelled() and done.exception() is None and done.result()))
+        else:
+            self.report(result)
 
 
 # This subclass does the bulk of the work to mimic a WeMo switch on the network.
 
 class Fauxmo(UPnPDevice):
+    # Without a handler of its own a device acts as one, failing every command
+    blocking = False
+    search_targets = (SEARCH_TARGET,)
+
     @staticmethod
     def make_uuid(name):
         return ''.join(["%x" % sum([ord(c) for c in name])] + ["%x" % ord(c) for c in "%sfauxmo!" % name])[:14]
 
-    def __init__(self, name, listener, poller, ip_address, port, action_handler=None):
+    def __init__(self, name, listener, ip_address, port, action_handler=None, http_server=None,
+                 coalesce_window=COALESCE_WINDOW, conflicts=(), action_timeout=ACTION_TIMEOUT):
         self.serial = self.make_uuid(name)
         self.name = name
         self.ip_address = ip_address
         persistent_uuid = "Socket-1_0-" + self.serial
         other_headers = ['X-User-Agent: redsonic']
-        UPnPDevice.__init__(self, listener, poller, port, "http://%(ip_address)s:%(port)s/setup.xml",
+        path_prefix = '/' + self.serial if http_server else ''
+        UPnPDevice.__init__(self, listener, port, "http://%(ip_address)s:%(port)s%(path_prefix)s/setup.xml",
                             "Unspecified, UPnP/1.0, Unspecified", persistent_uuid, other_headers=other_headers,
-                            ip_address=ip_address)
-        if action_handler:
-            self.action_handler = action_handler
-        else:
-            self.action_handler = self
-        dbg("FauxMo device '%s' ready on %s:%s" % (self.name, self.ip_address, self.port))
+                            ip_address=ip_address, http_server=http_server, path_prefix=path_prefix)
+
+        # Everything this device ever sends is built here, once.
+        self.search_response(SEARCH_TARGET)
+        service_list = SERVICE_LIST_XML % {'path_prefix': path_prefix} if http_server else ''
+        xml = SETUP_XML % {'device_name': self.name, 'device_serial': self.serial, 'service_list': service_list}
+        self.setup_response = CachedResponse(
+            "HTTP/1.1 200 OK\r\n"
+            "CONTENT-LENGTH: %d\r\n"
+            "CONTENT-TYPE: text/xml\r\n"
+            "DATE: " % len(xml.encode()),
+            "\r\n"
+            "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
+            "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+            "X-User-Agent: redsonic\r\n"
+            "CONNECTION: close\r\n"
+            "\r\n"
+            "%s" % xml)
+        # The echo is happy with the 200 status code and doesn't
+        # appear to care about the SOAP response body
+        self.action_response = self.soap_response("")
+        self.state_responses = [self.soap_response(BINARY_STATE_SOAP % {'state': state}) for state in (0, 1)]
+
+        self.state = 0
+        self.last_change = 0.0
+        self.commands_received = [0, 0]
+        self.commands_failed = 0
+        self.subscriptions = {}
+        self.action_handler = None
+        restored = JOURNAL.state(name) if JOURNAL is not None else None
+        if restored is not None:
+            self.state = restored
+        self.use_handler(action_handler or self, restored)
+
+        self.request_seconds = REGISTRY.histogram('fauxmo_http_request_seconds',
+                                                  "Time spent handling one HTTP request", device=name)
+        self.on_seconds = REGISTRY.histogram('fauxmo_action_seconds', "Time spent in an action handler",
+                                             device=name, action='on')
+        self.off_seconds = REGISTRY.histogram('fauxmo_action_seconds', "Time spent in an action handler",
+                                              device=name, action='off')
+        self.commands = CommandQueue(self.run_action, coalesce_window, self.queued_result)
+        self.conflicts = conflicts
+        self.action_timeout = action_timeout
+        self.actions_in_flight = 0
+
+        # Requests are dispatched on their SOAP action if they have one,
+        # otherwise on method and path.
+        self.soap_actions = {
+            b'urn:Belkin:service:basicevent:1#SetBinaryState': self.set_binary_state,
+            b'urn:Belkin:service:basicevent:1#GetBinaryState': self.get_binary_state,
+        }
+        self.routes = {
+            (b'GET', b'/setup.xml'): self.get_setup_xml,
+            (b'SUBSCRIBE', b'/upnp/event/basicevent1'): self.subscribe,
+            (b'UNSUBSCRIBE', b'/upnp/event/basicevent1'): self.unsubscribe,
+        }
+        if STATES is not None:
+            STATES.changed(self)
+        dbg("FauxMo device '%s' ready on %s:%s" % (self.name, ', '.join(self.ip_addresses), self.port))
 
     def get_name(self):
         return self.name
 
-    def handle_request(self, data, sender, socket):
-        if data.find('GET /setup.xml HTTP/1.1') == 0:
-            dbg("Responding to setup.xml for %s" % self.name)
-            xml = SETUP_XML % {'device_name': self.name, 'device_serial': self.serial}
-            date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-            message = ("HTTP/1.1 200 OK\r\n"
-                       "CONTENT-LENGTH: %d\r\n"
-                       "CONTENT-TYPE: text/xml\r\n"
-                       "DATE: %s\r\n"
-                       "LAST-MODIFIED: Sat, 01 Jan 2000 00:01:15 GMT\r\n"
-                       "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                       "X-User-Agent: redsonic\r\n"
-                       "CONNECTION: close\r\n"
-                       "\r\n"
-                       "%s" % (len(xml), date_str, xml))
-            socket.send(message)
-        elif data.find('SOAPACTION: "urn:Belkin:service:basicevent:1#SetBinaryState"') != -1:
-            success = False
-            if data.find('<BinaryState>1</BinaryState>') != -1:
-                # on
-                dbg("Responding to ON for %s" % self.name)
-                success = self.action_handler.on()
-            elif data.find('<BinaryState>0</BinaryState>') != -1:
-                # off
-                dbg("Responding to OFF for %s" % self.name)
-                success = self.action_handler.off()
-            else:
-                dbg("Unknown Binary State request:")
-                dbg(data)
-            if success:
-                # The echo is happy with the 200 status code and doesn't
-                # appear to care about the SOAP response body
-                soap = ""
-                date_str = email.utils.formatdate(timeval=None, localtime=False, usegmt=True)
-                message = ("HTTP/1.1 200 OK\r\n"
-                           "CONTENT-LENGTH: %d\r\n"
-                           "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
-                           "DATE: %s\r\n"
-                           "EXT:\r\n"
-                           "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
-                           "X-User-Agent: redsonic\r\n"
-                           "CONNECTION: close\r\n"
-                           "\r\n"
-                           "%s" % (len(soap), date_str, soap))
-                socket.send(message)
+    def stop(self):
+        UPnPDevice.stop(self)
+        self.close_handler()
+        if STATES is not None:
+            STATES.remove(self)
+
+    @staticmethod
+    def soap_response(soap):
+        return CachedResponse(
+            "HTTP/1.1 200 OK\r\n"
+            "CONTENT-LENGTH: %d\r\n"
+            "CONTENT-TYPE: text/xml charset=\"utf-8\"\r\n"
+            "DATE: " % len(soap.encode()),
+            "\r\n"
+            "EXT:\r\n"
+            "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+            "X-User-Agent: redsonic\r\n"
+            "CONNECTION: close\r\n"
+            "\r\n"
+            "%s" % soap)
+
+    def handle_request(self, request, sender):
+        start = time.perf_counter()
+        soap_action = request.headers.get(b'soapaction')
+        if soap_action is not None:
+            handler = self.soap_actions.get(soap_action.strip(b'"'))
+        else:
+            handler = self.routes.get((request.method, request.path))
+        if handler is None:
+            dbg("Unhandled %s %s for %s", request.method.decode(errors='replace'),
+                request.path.decode(errors='replace'), self.name)
+            response = HTTP_ERRORS[404]
+        else:
+            response = handler(request)
+        self.request_seconds.observe(time.perf_counter() - start)
+        return response
+
+    def get_setup_xml(self, request):
+        dbg("Responding to setup.xml for %s", self.name)
+        return self.setup_response
+
+    def set_binary_state(self, request):
+        if request.body.find(b'<BinaryState>1</BinaryState>') != -1:
+            command = 1
+        elif request.body.find(b'<BinaryState>0</BinaryState>') != -1:
+            command = 0
+        else:
+            dbg("Unknown Binary State request: %r", request.body)
+            return HTTP_ERRORS[400]
+        return self.command_response(command, self.action_response)
+
+    # Queue a command and answer with `success`, or a 500 if it fails. A
+    # command that has to wait is answered with a future instead.
+    def command_response(self, command, success):
+        self.commands_received[command] += 1
+        result = self.commands.submit(command)
+        if isinstance(result, asyncio.Future):
+            response = asyncio.get_running_loop().create_future()
+            result.add_done_callback(lambda done: response.set_result(self.action_result(done, success)))
+            return response
+        if not result:
+            self.command_failed()
+            return HTTP_ERRORS[500]
+        if STATES is not None:
+            STATES.changed(self)
+        return success
+
+    def action_result(self, future, success):
+        if future.cancelled() or future.exception() is not None or not future.result():
+            self.command_failed()
+            return HTTP_ERRORS[500]
+        if STATES is not None:
+            STATES.changed(self)
+        return success
+
+    # A command that had to wait was answered when it was queued
+    def queued_result(self, success):
+        if not success:
+            self.command_failed()
+        elif STATES is not None:
+            STATES.changed(self)
+
+    def command_failed(self):
+        self.commands_failed += 1
+        if STATES is not None:
+            STATES.changed(self)
+
+    # Runs one command from the queue. The handler may return an awaitable,
+    # which the queue waits on before running the next command. A device
+    # that shares equipment with conflict groups first takes each of them,
+    # always in the same order so that two devices never wait on each other,
+    # and lets go once its action has finished.
+    def run_action(self, command):
+        cancel = getattr(self.action_handler, 'cancel', None)
+        for index, group in enumerate(self.conflicts):
+            turn = group.acquire(self.name, cancel)
+            if turn is not None:
+                dbg("%s waiting for %s in its conflict group", self.name, group.holder)
+                return self.run_action_when_free(command, turn, index)
+        return self.run_action_holding(command)
+
+    async def run_action_when_free(self, command, turn, index):
+        cancel = getattr(self.action_handler, 'cancel', None)
+        try:
+            await turn
+            for group in self.conflicts[index + 1:]:
+                turn = group.acquire(self.name, cancel)
+                if turn is not None:
+                    await turn
+        except BaseException:
+            self.release_conflicts()
+            raise
+        success = self.run_action_holding(command)
+        if inspect.isawaitable(success):
+            success = await success
+        return success
+
+    def run_action_holding(self, command):
+        success = self.perform_action(command)
+        if not self.conflicts:
+            return success
+        if inspect.isawaitable(success):
+            success = asyncio.ensure_future(success)
+            success.add_done_callback(self.action_done)
+            return success
+        self.release_conflicts_after(success)
+        return success
+
+    def action_done(self, future):
+        self.release_conflicts_after(None if future.cancelled() or future.exception() is not None
+                                     else future.result())
+
+    # A pulse still running keeps the groups held until it is released
+    def release_conflicts_after(self, success):
+        released = getattr(success, 'released', None)
+        if released is None:
+            self.release_conflicts()
+        else:
+            released.add_done_callback(lambda done: self.release_conflicts())
+
+    def release_conflicts(self):
+        for group in self.conflicts:
+            group.release(self.name)
+
+    # Calls the handler's on() or off(): straight away if it doesn't block,
+    # as a coroutine if it is one, and otherwise in the action thread pool.
+    def perform_action(self, command):
+        dbg("Responding to %s for %s", "ON" if command else "OFF", self.name)
+        start = time.perf_counter()
+        handler = self.action_handler
+        try:
+            if isinstance(handler, LazyHandler):
+                handler = handler.load()
+            action = handler.on if command else handler.off
+            if getattr(handler, 'blocking', True) and not inspect.iscoroutinefunction(action):
+                return self.offload_action(command, action, start)
+            success = action()
+        except Exception as err:
+            LOG.warning("Action handler for %s failed: %s", self.name, err)
+            return False
+        if inspect.isawaitable(success):
+            return self.finish_action(command, success, start)
+        return self.action_finished(command, success, start)
+
+    def action_finished(self, command, success, start):
+        (self.on_seconds if command else self.off_seconds).observe(time.perf_counter() - start)
+        if success:
+            self.set_state(command)
+        return success
+
+    async def finish_action(self, command, pending, start):
+        try:
+            success = await asyncio.wait_for(pending, self.action_timeout)
+        except asyncio.TimeoutError:
+            LOG.warning("Action handler for %s timed out after %ss", self.name, self.action_timeout)
+            return False
+        except Exception as err:
+            LOG.warning("Action handler for %s failed: %s", self.name, err)
+            return False
+        return self.action_finished(command, success, start)
+
+    async def offload_action(self, command, action, start):
+        if self.actions_in_flight >= MAX_DEVICE_ACTIONS:
+            LOG.warning("%s already has %d actions running, refusing another", self.name, self.actions_in_flight)
+            return False
+        self.actions_in_flight += 1
+        running = asyncio.get_running_loop().run_in_executor(action_executor(), action)
+        running.add_done_callback(self.offloaded_action_done)
+        # Shielded, so that a timed out action still counts as in flight
+        # until its thread actually returns
+        return await self.finish_action(command, asyncio.shield(running), start)
+
+    def offloaded_action_done(self, running):
+        self.actions_in_flight -= 1
+
+    # Handlers running in the thread pool report state changes from their
+    # thread; those are passed over to the event loop.
+    def state_reported(self, state):
+        if self.loop is not None:
+            try:
+                running = asyncio.get_running_loop()
+            except RuntimeError:
+                running = None
+            if running is not self.loop:
+                self.loop.call_soon_threadsafe(self.set_state, state)
+                return
+        self.set_state(state)
+
+    # Status queries are answered from a cache. It is seeded from the
+    # handler's own idea of its state and then kept up to date by set_state,
+    # which handlers may also call themselves. A config reload may swap the
+    # handler of a running device through here as well. Handlers that can't
+    # read their state back from the hardware are given the state restored
+    # from the journal, if any.
+    def use_handler(self, action_handler, restored=None):
+        self.close_handler()
+        self.action_handler = action_handler
+        if restored is not None and hasattr(action_handler, 'restore_state'):
+            action_handler.restore_state(restored)
+        handler_state = getattr(action_handler, 'state', getattr(action_handler, 'internal_state', None))
+        if handler_state is not None:
+            self.set_state(handler_state)
+        if hasattr(action_handler, 'state_listener'):
+            action_handler.state_listener = self.state_reported
+
+    # Cut a handler that is being replaced or stopped off from us and from
+    # the pins it watches.
+    def close_handler(self):
+        handler = self.action_handler
+        if handler is None or handler is self:
+            return
+        if hasattr(handler, 'state_listener'):
+            handler.state_listener = None
+        close = getattr(handler, 'close', None)
+        if close is not None:
+            close()
+
+    def get_binary_state(self, request):
+        return self.state_responses[self.state]
+
+    def set_state(self, state):
+        state = 1 if state else 0
+        if state != self.state:
+            self.state = state
+            self.last_change = time.time()
+            if JOURNAL is not None:
+                JOURNAL.record(self.name, state)
+            if STATES is not None:
+                STATES.changed(self)
+            if self.http_server is not None:
+                self.http_server.device_state_changed(self)
+            self.notify_subscribers()
+
+    # UPnP eventing: subscribers register a callback URL and are sent a
+    # NOTIFY with the new BinaryState whenever it changes.
+
+    def subscribe(self, request):
+        sid = request.headers.get(b'sid', b'').decode(errors='replace')
+        if sid:
+            # Renewal of an existing subscription
+            subscription = self.subscriptions.get(sid)
+            if subscription is None:
+                return HTTP_ERRORS[400]
         else:
-            dbg(data)
+            callback = request.headers.get(b'callback', b'').strip(b'<>').decode(errors='replace')
+            url = urllib.parse.urlsplit(callback)
+            if url.scheme != 'http' or not url.hostname:
+                return HTTP_ERRORS[400]
+            sid = 'uuid:%s' % uuid.uuid4()
+            subscription = self.subscriptions[sid] = {
+                'host': url.hostname, 'port': url.port or 80, 'path': url.path or '/', 'seq': 0}
+        timeout = request.headers.get(b'timeout', b'').lower()
+        seconds = SUBSCRIPTION_TIMEOUT
+        if timeout.startswith(b'second-') and timeout[7:].isdigit():
+            seconds = int(timeout[7:])
+        subscription['expires'] = time.monotonic() + seconds
+        dbg("Event subscription %s for %s", sid, self.name)
+        return CachedResponse("HTTP/1.1 200 OK\r\n"
+                              "CONTENT-LENGTH: 0\r\n"
+                              "DATE: ",
+                              "\r\n"
+                              "SERVER: Unspecified, UPnP/1.0, Unspecified\r\n"
+                              "SID: %s\r\n"
+                              "TIMEOUT: Second-%d\r\n"
+                              "CONNECTION: close\r\n"
+                              "\r\n" % (sid, seconds))
+
+    def unsubscribe(self, request):
+        sid = request.headers.get(b'sid', b'').decode(errors='replace')
+        if self.subscriptions.pop(sid, None) is None:
+            return HTTP_ERRORS[400]
+        return self.action_response
+
+    def notify_subscribers(self):
+        if not self.subscriptions:
+            return
+        now = time.monotonic()
+        for sid, subscription in list(self.subscriptions.items()):
+            if subscription['expires'] < now:
+                del self.subscriptions[sid]
+                continue
+            asyncio.ensure_future(self.send_notify(sid, subscription, self.state))
+
+    async def send_notify(self, sid, subscription, state):
+        body = (BINARY_STATE_EVENT % {'state': state}).encode()
+        message = ("NOTIFY %s HTTP/1.1\r\n"
+                   "HOST: %s:%d\r\n"
+                   "CONTENT-TYPE: text/xml; charset=\"utf-8\"\r\n"
+                   "CONTENT-LENGTH: %d\r\n"
+                   "NT: upnp:event\r\n"
+                   "NTS: upnp:propchange\r\n"
+                   "SID: %s\r\n"
+                   "SEQ: %d\r\n"
+                   "CONNECTION: close\r\n"
+                   "\r\n" % (subscription['path'], subscription['host'], subscription['port'], len(body), sid,
+                               subscription['seq'])).encode() + body
+        subscription['seq'] += 1
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(subscription['host'], subscription['port']), 5)
+            writer.write(message)
+            await writer.drain()
+            writer.close()
+        except (OSError, asyncio.TimeoutError) as err:
+            dbg("Failed to notify %s for %s: %s", sid, self.name, err)
 
     def on(self):
         return False
@@ -278,28 +1442,61 @@ class Fauxmo(UPnPDevice):
 # we only need a single listener for UPnP broadcasts. When a matching
 # search is received, it causes each device instance to respond.
 #
-# Note that this is currently hard-coded to recognize only the search
-# from the Amazon Echo for WeMo devices. In particular, it does not
-# support the more common root device general search. The Echo
-# doesn't search for root devices.
+# Each device says which search targets it answers. WeMo devices only
+# answer the Echo's search for Belkin devices; an emulated Hue bridge also
+# answers root device and general searches.
+#
+# Each device's reply is scheduled at a random point within the search's
+# MX window and sent through one shared unicast socket. A sender that
+# searches again while its replies are still pending is not answered twice.
+#
+# The multicast group is joined on every interface we serve, and each reply
+# gives the address of the interface on the searcher's subnet.
+#
+# Searches pass through admit() first, which rate limits each sending host
+# and drops repeats of a search answered moments ago (see SSDP_RATE), so a
+# chatty client can't keep us busy answering it.
+#
+# When the devices are sharded across workers, only one responder joins the
+# multicast group. It forwards every admitted search to the other workers'
+# responders (forward_to), which listen on loopback with init_fanout_socket.
 
-class UPnPBroadcastResponder(object):
-    TIMEOUT = 0
+class UPnPBroadcastResponder(asyncio.DatagramProtocol):
+    SWEEP_INTERVAL = 10
 
-    def __init__(self):
+    def __init__(self, rate=SSDP_RATE, burst=SSDP_BURST, suppress=SSDP_SUPPRESS):
         self.devices = []
-
-    def init_socket(self):
+        self.targets = {}
+        self.ssock = None
+        self.usock = None
+        self.transport = None
+        self.pending = {}
+        self.forward_to = []
+        self.rate = rate
+        self.burst = burst
+        self.suppress = suppress
+        self.buckets = {}
+        self.answered = {}
+        self.next_sweep = 0
+        self.interfaces = []
+        REGISTRY.gauge('fauxmo_ssdp_rate_limit', "Searches per second answered per host").set(rate)
+        REGISTRY.gauge('fauxmo_ssdp_burst_limit', "Searches per host answered in a burst").set(burst)
+        REGISTRY.gauge('fauxmo_ssdp_suppress_seconds', "Repeat searches are dropped for this long").set(suppress)
+
+    def init_socket(self, port=1900, serve_interfaces=None):
         ok = True
         self.ip = '239.255.255.250'
-        self.port = 1900
+        self.port = port
+        if serve_interfaces is None:
+            serve_interfaces = interfaces.resolve(None)
+        self.interfaces = serve_interfaces
         try:
-            # This is needed to join a multicast group
-            self.mreq = struct.pack("4sl", socket.inet_aton(self.ip), socket.INADDR_ANY)
 
             # Set up server socket
             self.ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
             self.ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if REUSE_PORT:
+                self.ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
 
             try:
                 self.ssock.bind(('', self.port))
@@ -307,58 +1504,201 @@ class UPnPBroadcastResponder(object):
                 dbg("WARNING: Failed to bind %s: %d: %s" % (self.ip, self.port, err))
                 ok = False
 
-            try:
-                self.ssock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, self.mreq)
-            except Exception as err:
-                dbg('WARNING: Failed to join multicast group: ' + err.strerror)
+            # Join the multicast group on each interface
+            joined = 0
+            for interface in self.interfaces:
+                mreq = socket.inet_aton(self.ip) + socket.inet_aton(interface.address)
+                try:
+                    self.ssock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+                    joined += 1
+                except OSError as err:
+                    dbg('WARNING: Failed to join multicast group on %s: %s' % (interface.name, err.strerror))
+            if not joined:
                 ok = False
 
+            self.init_reply_socket()
+
         except Exception as err:
             dbg("Failed to initialize UPnP sockets: " + err.strerror)
+            self.ssock = None
             return False
         if ok:
             dbg("Listening for UPnP broadcasts")
 
-    def fileno(self):
-        return self.ssock.fileno()
-
-    def do_read(self, fileno):
-        data, sender = self.recvfrom(1024)
-        if data:
-            if data.find('M-SEARCH') == 0 and data.find('urn:Belkin:device:**') != -1:
-                for device in self.devices:
-                    time.sleep(0.1)
-                    device.respond_to_search(sender, 'urn:Belkin:device:**')
-            else:
-                pass
-
-    # Receive network data
-    def recvfrom(self, size):
-        if self.TIMEOUT:
-            self.ssock.setblocking(0)
-            ready = select.select([self.ssock], [], [], self.TIMEOUT)[0]
+    # Listen for searches forwarded by the worker that holds the multicast
+    # membership instead of joining the group ourselves.
+    def init_fanout_socket(self, port):
+        self.port = port
+        try:
+            self.ssock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+            self.ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if REUSE_PORT:
+                self.ssock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            self.ssock.bind(('127.0.0.1', port))
+            self.init_reply_socket()
+        except Exception as err:
+            dbg("Failed to initialize forwarded search socket: %s" % err)
+            self.ssock = None
+            return False
+        dbg("Listening for forwarded UPnP broadcasts on port %d" % port)
+
+    # All search replies go out through this one socket
+    def init_reply_socket(self):
+        self.usock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        self.usock.bind(('', 0))
+        self.usock.setblocking(False)
+
+    # Attach the multicast socket to the event loop so that searches are
+    # delivered to datagram_received as soon as they arrive.
+    async def start(self):
+        if self.ssock is None:
+            return
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: self, sock=self.ssock)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, sender):
+        forwarded = False
+        if not self.forward_to and data.startswith(b'FAUXMO-FORWARD ') and sender[0] == '127.0.0.1':
+            header, sep, data = data.partition(b'\r\n')
+            fields = header.split(b' ')
+            sender = (fields[1].decode(), int(fields[2]))
+            forwarded = True
+        elif CAPTURE is not None:
+            CAPTURE.record(capture.SEARCH, 0, sender, self.port, data)
+        if data.find(b'M-SEARCH') != 0:
+            return
+        match = ST_RE.search(data)
+        search_target = match.group(1).decode(errors='replace') if match else None
+        if search_target in SEARCH_TARGETS:
+            # Forwarded searches were already admitted by the first worker
+            if not forwarded and not self.admit(sender, search_target):
+                return
+            if self.forward_to:
+                message = FORWARD_HEADER % (sender[0].encode(), sender[1]) + data
+                for worker in self.forward_to:
+                    self.transport.sendto(message, worker)
+            devices = self.targets.get(search_target)
+            if not devices:
+                return
+            if sender in self.pending:
+                dbg("Coalescing search from %s:%s", *sender)
+                SSDP_COALESCED.inc()
+                return
+            start = time.perf_counter()
+            match = MX_RE.search(data)
+            mx = min(int(match.group(1)), MX_MAX) if match else MX_DEFAULT
+            ip_address = None
+            if len(self.interfaces) > 1:
+                ip_address = interfaces.local_address(self.interfaces, sender[0])
+            loop = asyncio.get_running_loop()
+            self.pending[sender] = len(devices)
+            for device in devices:
+                loop.call_later(random.uniform(0, mx), self.reply, device, sender, search_target, ip_address)
+            SSDP_SEARCHES.inc()
+            SSDP_SEARCH_SECONDS.observe(time.perf_counter() - start)
+
+    def admit(self, sender, search_target):
+        now = time.monotonic()
+        if now >= self.next_sweep:
+            self.sweep(now)
+        key = (sender, search_target)
+        answered = self.answered.get(key)
+        if answered is not None and now - answered < self.suppress:
+            SSDP_SUPPRESSED.inc()
+            return False
+        bucket = self.buckets.get(sender[0])
+        if bucket is None:
+            bucket = self.buckets[sender[0]] = [self.burst, now]
         else:
-            self.ssock.setblocking(1)
-            ready = True
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        if bucket[0] < 1:
+            dbg("Rate limiting searches from %s", sender[0])
+            SSDP_RATE_LIMITED.inc()
+            return False
+        bucket[0] -= 1
+        self.answered[key] = now
+        return True
 
+    # Forget hosts whose buckets have refilled and searches that are past
+    # suppression, so neither table grows with the number of senders seen.
+    def sweep(self, now):
+        self.next_sweep = now + self.SWEEP_INTERVAL
+        self.answered = {key: answered for key, answered in self.answered.items()
+                         if now - answered < self.suppress}
+        self.buckets = {host: bucket for host, bucket in self.buckets.items()
+                        if bucket[0] + (now - bucket[1]) * self.rate < self.burst}
+
+    def reply(self, device, sender, search_target, ip_address=None):
+        start = time.perf_counter()
         try:
-            if ready:
-                return self.ssock.recvfrom(size)
-            else:
-                return False, False
-        except Exception as e:
-            dbg(e)
-            return False, False
+            if not device.stopped:
+                device.respond_to_search(sender, search_target, ip_address)
+        finally:
+            SSDP_REPLY_SECONDS.observe(time.perf_counter() - start)
+            self.pending[sender] -= 1
+            if not self.pending[sender]:
+                del self.pending[sender]
+
+    def sendto(self, data, destination):
+        if CAPTURE is not None:
+            CAPTURE.record(capture.REPLY, 0, destination, self.port, data)
+        try:
+            self.usock.sendto(data, destination)
+        except OSError as err:
+            dbg("Failed to send search response to %s:%s: %s", destination[0], destination[1], err)
 
     def add_device(self, device):
         self.devices.append(device)
+        self.advertise(device)
         dbg("UPnP broadcast listener: new device registered")
 
+    def remove_device(self, device):
+        if device in self.devices:
+            self.devices.remove(device)
+            self.withdraw(device)
+            dbg("UPnP broadcast listener: device removed")
+
+    # Answer searches for any of `device`'s search targets with it. Devices
+    # are registered with add_device; anything else that answers searches
+    # (a Hue bridge) only with this.
+    def advertise(self, device):
+        for search_target in device.search_targets:
+            self.targets.setdefault(search_target, []).append(device)
+
+    def withdraw(self, device):
+        for search_target in device.search_targets:
+            devices = self.targets.get(search_target, [])
+            if device in devices:
+                devices.remove(device)
+
+
+# The thread pool for blocking action handlers, created on first use so each
+# worker process gets its own.
+
+ACTION_EXECUTOR = None
+
+
+def action_executor():
+    global ACTION_EXECUTOR
+    if ACTION_EXECUTOR is None:
+        ACTION_EXECUTOR = concurrent.futures.ThreadPoolExecutor(ACTION_THREADS, thread_name_prefix='fauxmo-action')
+    return ACTION_EXECUTOR
+
 
 # This is an example handler class. The fauxmo class expects handlers to be
 # instances of objects that have on() and off() methods that return True
 # on success and False otherwise.
 #
+# on() and off() may also be coroutines, which are awaited on the event loop.
+# Plain methods are assumed to block (on network I/O, say) and are run in
+# the action thread pool, unless the class sets `blocking = False` to say
+# they return straight away, as the GPIO handlers below do. A handler run in
+# the pool may still call its state_listener.
+#
 # This example class takes two full URLs that should be requested when an on
 # and off command are invoked respectively. It ignores any return data.
 
@@ -375,146 +1715,879 @@ class UPnPBroadcastResponder(object):
 #        r = requests.get(self.off_cmd)
 #        return r.status_code == 200
 
-class GPIOSwitch(object):
+# Base for handlers driving a single output pin. The pin is set up once in
+# the shared pin bank, which also holds its state. Whenever that state
+# changes it is pushed to state_listener (normally the Fauxmo device serving
+# the handler), so status queries never read the hardware.
+
+class GPIOOutput(object):
+    state_listener = None
+    blocking = False
+
     def __init__(self, pin_number):
         self.pin = pin_number
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.pin, GPIO.OUT)
-        self.state = GPIO.input(pin_number)
+        BANK.setup(self.pin)
+        BANK.add_listener(self.pin, self.state_changed)
+
+    @property
+    def state(self):
+        return BANK.state(self.pin)
+
+    def set_state(self, state):
+        BANK.set_state(self.pin, state)
+
+    # Take the state from the journal rather than from the pin, which for a
+    # one-shot output says nothing about what it drives.
+    def restore_state(self, state):
+        BANK.set_state(self.pin, state)
+
+    def state_changed(self, state):
+        if self.state_listener is not None:
+            self.state_listener(state)
+
+    # Called once the handler is no longer used, e.g. after a reload
+    def close(self):
+        BANK.remove_listener(self.pin, self.state_changed)
 
+
+class GPIOSwitch(GPIOOutput):
     def on(self):
         if self.state == 0:
-            GPIO.output(self.pin, 1)
-            self.state = GPIO.input(self.pin)
+            BANK.output(self.pin, 1)
+            self.set_state(BANK.level(self.pin))
             return True
 
     def off(self):
         if self.state == 1:
-            GPIO.output(self.pin, 0)
-            self.state = GPIO.input(self.pin)
+            BANK.output(self.pin, 0)
+            self.set_state(BANK.level(self.pin))
             return True
 
+    # A plain switch holds its level, so put the pin back where it was
+    def restore_state(self, state):
+        BANK.output(self.pin, state)
+        BANK.set_state(self.pin, state)
 
-class GPIOOneShot(object):
-    def __init__(self, pin_number):
-        self.pin = pin_number
-        GPIO.setmode(GPIO.BCM)
-        GPIO.setup(self.pin, GPIO.OUT)
-        self.state = GPIO.input(pin_number)
 
+class GPIOOneShot(GPIOOutput):
     def on(self):
-        if self.state == 0:
-            GPIO.output(self.pin, 1)
-            time.sleep(2)
-            GPIO.output(self.pin, 0)
-            self.state = 1
-        return True
+        return pulse_pins_to((self.pin,), 1)
 
     def off(self):
-        if self.state == 1:
-            GPIO.output(self.pin, 1)
-            time.sleep(2)
-            GPIO.output(self.pin, 0)
-            self.state = 0
+        return pulse_pins_to((self.pin,), 0)
+
+    def cancel(self):
+        return PULSES.cancel(self.pin)
+
+
+# What a pulsing action handler returns once its pulse has started. It is
+# true, so the command is answered straight away; `released` is done once
+# every pulse the action started is over, CONFLICT_GAP later, and until then
+# the device's command queue and any conflict groups it holds stay held.
+
+class Pressed(object):
+    def __init__(self, released):
+        self.released = released
+
+    def __bool__(self):
+        return True
+
+
+# Pulse every one-shot pin in a group that isn't already in the requested
+# state. The pins are written as one batch and share a single pulse, so the
+# whole group takes one PULSE_WIDTH however many pins it has.
+#
+# A pin still pulsing for another device, alone or in a group, is left to
+# finish and pressed again CONFLICT_GAP after it is released; pulsing it
+# straight away would only stretch the press in flight and lose this one.
+# Presses waiting for the same pin take their turns in the order they were
+# asked for. In that case the result is a future resolving to Pressed once
+# our own pulse has started. Without a loop (e.g. on a virtual clock) the
+# pulses are started and True is returned at once.
+
+def pulse_pins_to(pins, state):
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        busy = tuple(pin for pin in pins if not PULSES.ready(pin))
+        if busy:
+            LOG.warning("Pins %s are still pulsing, not pulsing them again", busy)
+        start_pulse(tuple(pin for pin in pins if pin not in busy), state)
         return True
+    if not all(PULSES.ready(pin) for pin in pins):
+        # What state the pins will be in is only known once it is our turn
+        started = loop.create_future()
+        sequence = loop.create_task(press_pins(pins, state, PULSES.claim(pins), started))
+        started.add_done_callback(lambda done: done.cancelled() and sequence.cancel())
+        return started
+    pins = [pin for pin in pins if BANK.state(pin) != state]
+    if not pins:
+        return True
+    batch, later = first_batch(pins)
+    released = start_pulse(batch, state)
+    return Pressed(loop.create_task(press_pins(later, state, PULSES.claim(later), released=released)))
+
+
+# Presses `pins` in as few batches as they allow, once `released` (a pulse
+# already started) is over, taking the turns `ticket` has claimed on them.
+# Resolves `started` when the first pulse starts.
+
+async def press_pins(pins, state, ticket, started=None, released=None):
+    try:
+        if released is not None:
+            await released
+            await asyncio.sleep(CONFLICT_GAP)
+        while pins:
+            free = [pin for pin in pins if PULSES.ready(pin, ticket)]
+            if not free:
+                await PULSES.turn(ticket, pins)
+                await asyncio.sleep(CONFLICT_GAP)
+                continue
+            # A pin's state is only known once it is our turn to press it
+            PULSES.unclaim(ticket, [pin for pin in free if BANK.state(pin) == state])
+            batch, later = first_batch([pin for pin in free if BANK.state(pin) != state])
+            pins = [pin for pin in pins if pin not in free] + later
+            if not batch:
+                continue
+            released = start_pulse(batch, state)
+            PULSES.unclaim(ticket, batch)
+            if started is not None and not started.done():
+                started.set_result(Pressed(asyncio.current_task()))
+            if released is not None:
+                await released
+                await asyncio.sleep(CONFLICT_GAP)
+    finally:
+        PULSES.unclaim(ticket, pins)
+        if started is not None and not started.done():
+            started.set_result(True)
+    return True
+
+
+# Splits off the pins that can be pulsed together: at most one of each
+# conflict group, and any number that belong to none.
+
+def first_batch(pins):
+    batch = []
+    later = []
+    groups = set()
+    for pin in pins:
+        group = CONFLICT_PINS.get(pin)
+        if group is not None:
+            if group in groups:
+                later.append(pin)
+                continue
+            groups.add(group)
+        batch.append(pin)
+    return tuple(batch), later
+
+
+# Starts one pulse on whichever of `pins` aren't in `state` yet. Returns a
+# future resolved when it is released, if there is a loop to resolve it on.
+
+def start_pulse(pins, state):
+    pins = tuple(pin for pin in pins if BANK.state(pin) != state)
+    if not pins:
+        return None
+    released = done = None
+    try:
+        released = asyncio.get_running_loop().create_future()
+        done = functools.partial(settle, released, True)
+    except RuntimeError:
+        pass
+    PULSES.pulse(pins if len(pins) > 1 else pins[0], PULSE_WIDTH, done=done)
+    BANK.set_state(pins, state)
+    return released
+
+
+def settle(future, result):
+    if not future.done():
+        future.set_result(result)
 
 
 class GPIOAllOff(object):
+    blocking = False
+
     def __init__(self, pin_numbers):
         self.pins = pin_numbers
+        BANK.setup(self.pins)
 
     def on(self):
-        for pin in self.pins:
-            if GPIOOneShot(pin).state == 0:
-                GPIOOneShot(pin).on()
-        return True
+        return pulse_pins_to(self.pins, 1)
 
     def off(self):
-        for pin in self.pins:
-            if GPIOOneShot(pin).state == 1:
-                GPIOOneShot(pin).off()
-        return True
+        return pulse_pins_to(self.pins, 0)
 
 
 class GPIOReset(object):
+    blocking = False
+
     def __init__(self, pin_numbers):
         self.pins = pin_numbers
+        BANK.setup(self.pins)
 
     def on(self):
-        for pin in self.pins:
-            GPIOOneShot(pin).off()
-        return True
+        return pulse_pins_to(self.pins, 0)
 
     def off(self):
         return True
 
 
+GPIO_HANDLERS = (GPIOSwitch, GPIOOneShot, GPIOAllOff, GPIOReset)
+
+
+# Stands in for an action handler until it is first needed, so that
+# hardware set-up and plugin imports don't hold up the sockets at startup.
+# serve() loads every handler in the background once the devices are
+# listening; a command that arrives first loads its own handler on the spot.
+
+class LazyHandler(object):
+    state_listener = None
+    restored = None
+
+    def __init__(self, factory, *args, **kwargs):
+        self.factory = factory
+        self.args = args
+        self.kwargs = kwargs
+        self.handler = None
+
+    def load(self):
+        if self.handler is None:
+            handler = self.factory(*self.args, **self.kwargs)
+            self.handler = handler
+            if hasattr(handler, 'state_listener'):
+                handler.state_listener = self.report_state
+            if self.restored is not None and hasattr(handler, 'restore_state'):
+                handler.restore_state(self.restored)
+            state = getattr(handler, 'state', getattr(handler, 'internal_state', None))
+            if state is not None:
+                self.report_state(state)
+        return self.handler
+
+    def report_state(self, state):
+        if self.state_listener is not None:
+            self.state_listener(state)
+
+    # Held until the handler is loaded, then passed on to it
+    def restore_state(self, state):
+        self.restored = state
+        if self.handler is not None and hasattr(self.handler, 'restore_state'):
+            self.handler.restore_state(state)
+
+    def on(self):
+        return self.load().on()
+
+    def off(self):
+        return self.load().off()
+
+    # Whether `other` would build the same handler, so a config reload can
+    # leave a device that didn't change alone.
+    def same_as(self, other):
+        return (isinstance(other, LazyHandler) and self.factory is other.factory and self.args == other.args
+                and self.kwargs == other.kwargs)
+
+    def cancel(self):
+        cancel = getattr(self.handler, 'cancel', None)
+        if cancel is not None:
+            return cancel()
+        return False
+
+    def close(self):
+        close = getattr(self.handler, 'close', None)
+        if close is not None:
+            close()
+
+
+# The GPIO pins a device's handler drives, worked out without loading it:
+# the first argument of a built-in GPIO handler, or a plugin's "pin"
+# setting. Any other handler drives no pins that we know of.
+
+def handler_pins(handler):
+    if isinstance(handler, LazyHandler):
+        if 'pin' in handler.kwargs:
+            pins = handler.kwargs['pin']
+        elif handler.factory in GPIO_HANDLERS and handler.args:
+            pins = handler.args[0]
+        else:
+            return ()
+    else:
+        pins = getattr(handler, 'pins', getattr(handler, 'pin', ()))
+    return tuple(pin for pin in as_pins(pins) if isinstance(pin, int))
+
+
+# Minimal stand-in for fauxmo.plugins.FauxmoPlugin from the fauxmo package,
+# so plugins written for it (like GPIORPiPlugin) can be loaded here as well.
+
+class FauxmoPlugin(abc.ABC):
+    def __init__(self, *, name, port):
+        self._name = name
+        self._port = port
+
+    @property
+    def name(self):
+        return self._name
+
+    @property
+    def port(self):
+        return self._port
+
+    @abc.abstractmethod
+    def on(self):
+        pass
+
+    @abc.abstractmethod
+    def off(self):
+        pass
+
+
+# Builds devices from a plugin class, importing the plugin's module from its
+# path the first time one of its devices is needed.
+
+class PluginFactory(object):
+    def __init__(self, class_name, path):
+        self.class_name = class_name
+        self.path = path
+        self.plugin_class = None
+
+    def __call__(self, **kwargs):
+        if self.plugin_class is None:
+            module_name = os.path.splitext(os.path.basename(self.path))[0]
+            spec = importlib.util.spec_from_file_location(module_name, self.path)
+            module = importlib.util.module_from_spec(spec)
+            sys.modules[module_name] = module
+            spec.loader.exec_module(module)
+            self.plugin_class = getattr(module, self.class_name)
+        return self.plugin_class(**kwargs)
+
+
+# Read a fauxmo config file (see house.json) into the same form as FAUXMOS.
+# Nothing is imported or touched on the hardware here; every device gets a
+# LazyHandler. Returns the configured IP address (None for "auto"), the
+# device list and the conflict groups. Plugin factories are kept across
+# reloads so that each plugin module is only ever imported once.
+
+PLUGIN_FACTORIES = {}
+
+
+def load_config(path):
+    with open(path) as config_file:
+        config = json.load(config_file)
+    ip_address = config.get('FAUXMO', {}).get('ip_address', 'auto')
+    if ip_address == 'auto':
+        ip_address = None
+    config_dir = os.path.dirname(os.path.abspath(path))
+    devices = []
+    for class_name, plugin in config.get('PLUGINS', {}).items():
+        plugin_path = os.path.join(config_dir, os.path.expanduser(plugin['path']))
+        factory = PLUGIN_FACTORIES.get((class_name, plugin_path))
+        if factory is None:
+            factory = PLUGIN_FACTORIES[(class_name, plugin_path)] = PluginFactory(class_name, plugin_path)
+        for device in plugin.get('DEVICES', []):
+            devices.append([device['name'], LazyHandler(factory, **device), device.get('port', 0)])
+    return ip_address, devices, config.get('CONFLICTS', [])
+
+
+# Load every LazyHandler in the background, one per pass of the event loop
+# so that requests keep being served in between.
+
+async def load_handlers(devices, timer=None):
+    for device in list(devices):
+        handler = device.action_handler
+        if isinstance(handler, LazyHandler):
+            try:
+                handler.load()
+            except Exception as err:
+                dbg("Failed to initialise handler for %s: %s" % (device.name, err))
+            await asyncio.sleep(0)
+    if timer is not None:
+        timer.phase("action handlers initialised")
+
+
+# Logs how long each phase of startup took, measured from when this module
+# was first imported.
+
+class StartupTimer(object):
+    def __init__(self, start):
+        self.start = start
+        self.last = start
+
+    def phase(self, name):
+        now = time.perf_counter()
+        dbg("Startup: %s in %.1fms (%.1fms since start)" % (name, (now - self.last) * 1000,
+                                                           (now - self.start) * 1000))
+        self.last = now
+
+
 # Each entry is a list with the following elements:
 #
 # name of the virtual switch
 # object with 'on' and 'off' methods
 # port # (optional; may be omitted)
+#
+# These are used when no config file is given. Handlers are wrapped in a
+# LazyHandler so that nothing touches GPIO until the sockets are up.
 
 # NOTE: As of 2015-08-17, the Echo appears to have a hard-coded limit of
 # 16 switches it can control. Only the first 16 elements of the FAUXMOS
-# list will be used.
+# list will be used. With --persona hue the devices are lights behind one
+# Hue bridge instead, which isn't limited to 16.
 
 FAUXMOS = [
-    ['lounge room', GPIOOneShot(14), 58301],
-    ['living room,', GPIOOneShot(15), 58302],
-    ['bed one', GPIOOneShot(18), 58303],
-    ['set cooling', GPIOOneShot(23), 58304],
-    ['set heating', GPIOOneShot(24), 58305],
-    ['increase temp one degree', GPIOOneShot(25), 58306],
-    ['decrease temp one degree', GPIOOneShot(8), 58307],
-    ['set twenty degrees', GPIOOneShot(7), 58308],
-    ['set twenty one degrees', GPIOOneShot(1), 58309],
-    ['set twenty two degrees', GPIOOneShot(12), 58310],
-    ['set twenty three degrees', GPIOOneShot(16), 58311],
-    ['set twenty four degrees', GPIOOneShot(20), 58312],
-    ['system', GPIOAllOff([14, 15, 18]), 58313],  # only the pins that go to actual fancoils
-    ['reset toggles', GPIOReset([14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16, 20]), 58314],  # all pins
+    ['lounge room', LazyHandler(GPIOOneShot, 14), 58301],
+    ['living room,', LazyHandler(GPIOOneShot, 15), 58302],
+    ['bed one', LazyHandler(GPIOOneShot, 18), 58303],
+    ['set cooling', LazyHandler(GPIOOneShot, 23), 58304],
+    ['set heating', LazyHandler(GPIOOneShot, 24), 58305],
+    ['increase temp one degree', LazyHandler(GPIOOneShot, 25), 58306],
+    ['decrease temp one degree', LazyHandler(GPIOOneShot, 8), 58307],
+    ['set twenty degrees', LazyHandler(GPIOOneShot, 7), 58308],
+    ['set twenty one degrees', LazyHandler(GPIOOneShot, 1), 58309],
+    ['set twenty two degrees', LazyHandler(GPIOOneShot, 12), 58310],
+    ['set twenty three degrees', LazyHandler(GPIOOneShot, 16), 58311],
+    ['set twenty four degrees', LazyHandler(GPIOOneShot, 20), 58312],
+    ['system', LazyHandler(GPIOAllOff, [14, 15, 18]), 58313],  # only the pins that go to actual fancoils
+    ['reset toggles', LazyHandler(GPIOReset, [14, 15, 18, 23, 24, 25, 8, 7, 1, 12, 16, 20]), 58314],  # all pins
 ]
 
-CONFLICTS = [[],
-             ]
+# Groups of devices from FAUXMOS that must never act at the same time. A
+# command for one of them waits until any pulse in flight in its group has
+# finished. A group may also be given as {"devices": [...], "preempt": True}
+# to cut the pulse in flight short instead. Any other device that drives one
+# of a group's pins, like "reset toggles", waits for the group as well.
 
-if len(sys.argv) > 1 and sys.argv[1] == '-d':
-    DEBUG = True
+CONFLICTS = [
+    ['set cooling', 'set heating', 'increase temp one degree', 'decrease temp one degree',
+     'set twenty degrees', 'set twenty one degrees', 'set twenty two degrees', 'set twenty three degrees',
+     'set twenty four degrees'],
+]
 
-# Set up our singleton for polling the sockets for data ready
-p = Poller()
 
-# Set up our singleton listener for UPnP broadcasts
-u = UPnPBroadcastResponder()
-u.init_socket()
+# The conflict groups of a device list, owning the pins their devices drive.
+# On a reload the groups of `previous` whose devices didn't change are kept,
+# so that a device holding one, or waiting for it, isn't forgotten.
+
+def conflict_index_for(devices, conflicts, previous=None):
+    global CONFLICT_PINS
+    conflict_index = ConflictIndex(conflicts, CONFLICT_GAP,
+                                   {one_faux[0]: handler_pins(one_faux[1]) for one_faux in devices}, previous)
+    CONFLICT_PINS = conflict_index.pins
+    return conflict_index
+
+
+# The entries of `devices` that belong to this worker. Devices that drive a
+# pin in common, or that are in one conflict group, are connected, and each
+# connected set goes to a single worker: every worker has a pin bank and
+# pulse scheduler of its own, and a LEECH device can only drive pins that
+# devices in its own worker have set up. The sets are dealt out to the
+# workers in turn, in the order of their first devices.
+
+def worker_share(devices, conflict_index, worker, workers):
+    roots = list(range(len(devices)))
+
+    def find(index):
+        while roots[index] != index:
+            roots[index] = roots[roots[index]]
+            index = roots[index]
+        return index
+
+    owners = {}
+    for index, one_faux in enumerate(devices):
+        group = conflict_index.group(one_faux[0])
+        keys = [('device', one_faux[0] if group is None else group.names[0])]
+        keys.extend(('pin', pin) for pin in handler_pins(one_faux[1]))
+        for key in keys:
+            first, this = find(owners.setdefault(key, index)), find(index)
+            roots[max(first, this)] = min(first, this)
+    sets = {}
+    for index in range(len(devices)):
+        sets.setdefault(find(index), len(sets))
+    if worker == 0 and workers > 1:
+        if len(sets) == 1 and len(devices) > 1:
+            LOG.warning("All %d devices share pins or a conflict group, so one worker serves them all",
+                        len(devices))
+        elif len(sets) < workers:
+            LOG.warning("Devices only split into %d sets that share no pins, so %d of %d workers will be idle",
+                        len(sets), workers - len(sets), workers)
+    share = []
+    for index, one_faux in enumerate(devices):
+        if sets[find(index)] % workers != worker:
+            continue
+        if len(one_faux) == 2:
+            # a fixed port wasn't specified, use a dynamic one
+            one_faux.append(0)
+        share.append(one_faux)
+    return share
+
+
+# Keeps the running devices in step with the config file. On SIGHUP, or when
+# the file's modification time changes, the file is read again and diffed
+# by name against the running devices. A device whose name and port are
+# unchanged keeps its socket, cached responses and state, and only has its
+# handler swapped if that changed; everything else is torn down or created.
+# Nothing is re-advertised for devices that didn't change.
+
+class Reloader(object):
+    def __init__(self, path, listener, ip_address, options, worker=0, workers=1, mtime=None,
+                 conflict_index=None, config_ip_address=None):
+        self.path = path
+        self.listener = listener
+        self.ip_address = ip_address
+        self.config_ip_address = config_ip_address
+        self.conflict_index = conflict_index
+        self.options = options
+        self.worker = worker
+        self.workers = workers
+        self.mtime = mtime
+        self.reloading = None
+
+    def start(self):
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGHUP, self.trigger)
+        loop.create_task(self.watch())
+
+    def trigger(self):
+        if self.reloading is None or self.reloading.done():
+            self.reloading = asyncio.get_running_loop().create_task(self.reload())
+
+    async def watch(self):
+        while True:
+            try:
+                mtime = os.stat(self.path).st_mtime
+            except OSError:
+                mtime = self.mtime
+            if mtime != self.mtime:
+                self.trigger()
+            await asyncio.sleep(RELOAD_INTERVAL)
+
+    async def reload(self):
+        start = time.perf_counter()
+        try:
+            mtime = os.stat(self.path).st_mtime
+            ip_address, devices, conflicts = load_config(self.path)
+            conflict_index = conflict_index_for(devices, conflicts, self.conflict_index)
+        except Exception as err:
+            dbg("Not reloading %s: %s" % (self.path, err))
+            return
+        self.mtime = mtime
+        self.conflict_index = conflict_index
+        if ip_address != self.config_ip_address:
+            dbg("ip_address changes only take effect on restart")
+            self.config_ip_address = ip_address
+
+        wanted = {one_faux[0]: one_faux for one_faux in worker_share(devices, conflict_index, self.worker,
+                                                                      self.workers)}
+        changed = []
+        removed = 0
+        for device in list(self.listener.devices):
+            one_faux = wanted.get(device.name)
+            if one_faux is None or one_faux[2] != device.requested_port:
+                device.stop()
+                removed += 1
+                continue
+            del wanted[device.name]
+            handler = one_faux[1]
+            device.conflicts = conflict_index.groups_for(device.name, handler_pins(handler))
+            if not (isinstance(handler, LazyHandler) and handler.same_as(device.action_handler)):
+                device.use_handler(handler)
+                changed.append(device)
+
+        for one_faux in wanted.values():
+            try:
+                device = Fauxmo(one_faux[0], self.listener, self.ip_address, one_faux[2],
+                                action_handler=one_faux[1],
+                                conflicts=conflict_index.groups_for(one_faux[0], handler_pins(one_faux[1])),
+                                **self.options)
+                await device.start()
+            except OSError as err:
+                dbg("Failed to add %s: %s" % (one_faux[0], err))
+                continue
+            changed.append(device)
 
-# Add the UPnP broadcast listener to the poller so we can respond
-# when a broadcast is received.
-p.add(u)
+        dbg("Reloaded %s in %.1fms: %d added, %d removed, %d handlers replaced" % (
+            self.path, (time.perf_counter() - start) * 1000, len(wanted), removed,
+            len(changed) - len(wanted)))
+        await load_handlers(changed)
 
-# Create our FauxMo virtual switch devices
-for one_faux in FAUXMOS:
-    if len(one_faux) == 2:
-        # a fixed port wasn't specified, use a dynamic one
-        one_faux.append(0)
-    switch = Fauxmo(one_faux[0], u, p, None, one_faux[2], action_handler=one_faux[1])
 
-dbg("Entering main loop\n")
+# Blink the status LED for as long as the event loop is running.
 
-try:
-    status_led = GPIOSwitch(17)
+async def heartbeat(status_led, interval=0.1):
     while True:
+        status_led.on()
+        await asyncio.sleep(interval)
+        status_led.off()
+        await asyncio.sleep(interval)
+
+
+async def serve(devices=FAUXMOS, ip_address=None, http_port=None, metrics_port=None, worker=0, workers=1,
+                coalesce_window=COALESCE_WINDOW, conflicts=CONFLICTS, config=None, config_mtime=None,
+                idle_timeout=IDLE_TIMEOUT, max_connections=MAX_CONNECTIONS,
+                max_device_connections=MAX_DEVICE_CONNECTIONS, ssdp_rate=SSDP_RATE, ssdp_burst=SSDP_BURST,
+                ssdp_suppress=SSDP_SUPPRESS, state_file=None, action_timeout=ACTION_TIMEOUT, capture_file=None,
+                persona='wemo', state_export=None, config_ip_address=None):
+    global JOURNAL, CAPTURE, STATES
+    timer = StartupTimer(STARTED)
+    CONNECTIONS.configure(idle_timeout, max_connections, max_device_connections)
+    timer.phase("imports and configuration")
+
+    # Open the state journal before any device asks it for its last state.
+    # Workers each keep their own.
+    if state_file is not None:
+        JOURNAL = StateJournal(state_file if workers == 1 else '%s.%d' % (state_file, worker))
+        dbg("Restored %d device states from %s" % (len(JOURNAL.latest), JOURNAL.path))
+    if capture_file is not None:
+        CAPTURE = capture.Capture(capture_file if workers == 1 else '%s.%d' % (capture_file, worker))
+        dbg("Capturing traffic to %s" % CAPTURE.path)
+    if state_export is not None:
+        STATES = StateExport(state_export if workers == 1 else '%s.%d' % (state_export, worker))
+        dbg("Publishing device states to %s" % STATES.path)
+
+    # Find the interfaces to serve on from the kernel, without needing a
+    # route off the network
+    serve_interfaces = interfaces.resolve(ip_address)
+    ip_address = [interface.address for interface in serve_interfaces]
+
+    # Set up our singleton listener for UPnP broadcasts. With several
+    # workers only the first one listens for them, passing them on to the rest.
+    u = UPnPBroadcastResponder(ssdp_rate, ssdp_burst, ssdp_suppress)
+    if worker == 0:
+        u.init_socket(serve_interfaces=serve_interfaces)
+        u.forward_to = [('127.0.0.1', FANOUT_PORT + other) for other in range(1, workers)]
+    else:
+        u.init_fanout_socket(FANOUT_PORT + worker)
+        u.interfaces = serve_interfaces
+
+    # In single-port mode every device shares one HTTP listener. As a Hue
+    # bridge they always do, and only the bridge is advertised.
+    http_server = None
+    if persona == 'hue':
+        http_server = HueBridge(u, ip_address, HUE_PORT if http_port is None else http_port)
+    elif http_port is not None:
+        http_server = UPnPHTTPServer(ip_address, http_port)
+
+    # Create our FauxMo virtual switch devices, or this worker's share of them
+    conflict_index = conflict_index_for(devices, conflicts)
+    for one_faux in worker_share(devices, conflict_index, worker, workers):
+        switch = Fauxmo(one_faux[0], u, ip_address, one_faux[2], action_handler=one_faux[1],
+                        http_server=http_server, coalesce_window=coalesce_window,
+                        conflicts=conflict_index.groups_for(one_faux[0], handler_pins(one_faux[1])),
+                        action_timeout=action_timeout)
+    timer.phase("sockets bound")
+
+    # Hand the UPnP broadcast listener and every device's listening socket
+    # to the event loop so we can respond when data is received.
+    await u.start()
+    if http_server:
+        await http_server.start()
+    for device in u.devices:
+        await device.start()
+    timer.phase("answering searches")
+
+    if metrics_port is not None:
+        await serve_metrics(metrics_port + worker)
+        dbg("Serving metrics on 127.0.0.1:%s" % (metrics_port + worker))
+
+    dbg("Entering main loop\n")
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGUSR1, LOG.write_dump, DUMP_EVENTS)
+    loop.create_task(load_handlers(u.devices, timer))
+    if worker == 0:
+        loop.create_task(heartbeat(GPIOSwitch(17)))
+    loop.create_task(monitor_loop_lag(LOOP_LAG_SECONDS))
+    if JOURNAL is not None:
+        loop.create_task(JOURNAL.maintain())
+    if CAPTURE is not None:
+        loop.create_task(CAPTURE.maintain())
+    if config is not None:
+        Reloader(config, u, ip_address, {'http_server': http_server, 'coalesce_window': coalesce_window,
+                                          'action_timeout': action_timeout},
+                 worker, workers, config_mtime, conflict_index, config_ip_address).start()
+    await loop.create_future()
+
+
+# SIGTERM ends a worker the same way as an error does, closing its files
+# and releasing the pins on the way out.
+
+def stop_on_signal(signum, frame):
+    raise SystemExit(0)
+
+
+# A worker whose supervisor has gone, even by SIGKILL, would keep its
+# ports and pins with nothing left to restart or stop it, so it stops
+# itself as soon as it is handed to a new parent.
+
+def watch_supervisor(supervisor):
+    while os.getppid() == supervisor:
+        time.sleep(SUPERVISOR_CHECK)
+    LOG.warning("Supervisor %d has gone, stopping", supervisor)
+    os.kill(os.getpid(), signal.SIGTERM)
+
+
+def run_worker(worker, workers, serve_args, supervisor=None):
+    # Don't run the supervisor's SIGHUP forwarding in here
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, stop_on_signal)
+    LOG.start()
+    if supervisor is not None:
+        threading.Thread(target=watch_supervisor, args=(supervisor,), name='fauxmo-supervisor-watch',
+                         daemon=True).start()
+    try:
+        asyncio.run(serve(worker=worker, workers=workers, **serve_args))
+    except KeyboardInterrupt:
+        pass
+    except Exception as err:
+        # The traceback itself goes to stderr; put the events leading up to it next to it
+        LOG.error("Worker %d failed: %r", worker, err)
+        LOG.write_dump(DUMP_EVENTS)
+        raise
+    finally:
+        if JOURNAL is not None:
+            JOURNAL.close()
+        if CAPTURE is not None:
+            CAPTURE.close()
+        if STATES is not None:
+            STATES.close()
+        GPIO.cleanup()
+        LOG.drain()
+
+
+# Runs each shard of FAUXMOS in its own worker process and restarts any
+# worker that dies. Only the dead worker's devices go away and come back;
+# the others keep their sockets and are never re-advertised. worker_share
+# keeps devices that drive the same pins in one worker, since each worker
+# has its own pin bank.
+
+class Supervisor(object):
+    RESTART_DELAY = 1
+
+    def __init__(self, workers, serve_args):
+        self.context = multiprocessing.get_context('fork')
+        self.workers = [None] * workers
+        self.serve_args = serve_args
+
+    def start_worker(self, worker):
+        process = self.context.Process(target=run_worker,
+                                       args=(worker, len(self.workers), self.serve_args, os.getpid()),
+                                       name='fauxmo-worker-%d' % worker, daemon=True)
+        process.start()
+        self.workers[worker] = process
+        dbg("Started worker %d as pid %d" % (worker, process.pid))
+
+    # Pass a reload request on to every worker.
+    def forward_signal(self, signum, frame):
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                os.kill(process.pid, signum)
+
+    def run(self):
+        # Stopping the supervisor stops the workers with it, in the finally below
+        signal.signal(signal.SIGTERM, stop_on_signal)
+        for worker in range(len(self.workers)):
+            self.start_worker(worker)
+        if self.serve_args.get('config') is not None:
+            signal.signal(signal.SIGHUP, self.forward_signal)
+        try:
+            while True:
+                sentinels = {process.sentinel: worker for worker, process in enumerate(self.workers)}
+                for ready in multiprocessing.connection.wait(list(sentinels)):
+                    worker = sentinels[ready]
+                    self.workers[worker].join()
+                    LOG.warning("Worker %d exited with %s, restarting", worker, self.workers[worker].exitcode)
+                    # Don't spin if a worker dies straight away every time
+                    time.sleep(self.RESTART_DELAY)
+                    self.start_worker(worker)
+        finally:
+            signal.signal(signal.SIGTERM, signal.SIG_IGN)
+            for process in self.workers:
+                if process is not None and process.is_alive():
+                    process.terminate()
+            for process in self.workers:
+                if process is not None:
+                    process.join()
+
+
+def main():
+    global REUSE_PORT
+    parser = argparse.ArgumentParser(description="Emulate WeMo switches for the Amazon Echo")
+    parser.add_argument('-d', '--debug', action='store_true', help="print debugging output")
+    parser.add_argument('-l', '--log-file', default=None, help="append log output to this file instead of stdout")
+    parser.add_argument('-c', '--config', default=None,
+                        help="load devices from this config file (see house.json) instead of FAUXMOS")
+    parser.add_argument('-p', '--http-port', type=int, default=None,
+                        help="serve every device from this one HTTP port instead of a port per device")
+    parser.add_argument('-m', '--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics on this port on 127.0.0.1 (plus the worker number)")
+    parser.add_argument('--coalesce-window', type=float, default=COALESCE_WINDOW,
+                        help="seconds within which a repeated command is answered without running again")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT,
+                        help="close client connections idle for this many seconds")
+    parser.add_argument('--max-connections', type=int, default=MAX_CONNECTIONS,
+                        help="most client connections open at once (per worker)")
+    parser.add_argument('--max-device-connections', type=int, default=MAX_DEVICE_CONNECTIONS,
+                        help="most client connections open at once to one listening socket")
+    parser.add_argument('--ssdp-rate', type=float, default=SSDP_RATE,
+                        help="searches per second answered for each host, once its burst is used up")
+    parser.add_argument('--ssdp-burst', type=int, default=SSDP_BURST,
+                        help="searches answered for each host in a burst")
+    parser.add_argument('--ssdp-suppress', type=float, default=SSDP_SUPPRESS,
+                        help="seconds during which a repeated search from the same sender is dropped")
+    parser.add_argument('-i', '--interface', action='append', default=None,
+                        help="serve on this interface name or address; may be given more than once "
+                             "(default: the config file's ip_address, or every interface)")
+    parser.add_argument('--action-timeout', type=float, default=ACTION_TIMEOUT,
+                        help="seconds before an action handler that hasn't returned is treated as failed")
+    parser.add_argument('-s', '--state-file', default=None,
+                        help="record device states in this journal and restore them on startup")
+    parser.add_argument('--capture', default=None,
+                        help="record SSDP and HTTP traffic to this file, for replay.py")
+    parser.add_argument('--state-export', default=None,
+                        help="publish device states and command counts to this file for sharedstate.py readers")
+    parser.add_argument('--persona', choices=('wemo', 'hue'), default='wemo',
+                        help="present each device as a WeMo switch, or all of them as lights behind one "
+                             "Hue bridge (on --http-port, default %d)" % HUE_PORT)
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="split the devices across this many worker processes")
+    args = parser.parse_args()
+    if args.debug:
+        LOG.level = eventlog.DEBUG
+    if args.log_file:
+        LOG.output = open(args.log_file, 'ab')
+    LOG.start()
+    if args.workers > 1 and args.http_port is not None:
+        parser.error("single-port mode can't be split across workers")
+    if args.workers > 1 and args.persona == 'hue':
+        parser.error("the Hue bridge can't be split across workers")
+
+    # Plugins import FauxmoPlugin from us; make sure they get this module
+    # rather than a second copy of it.
+    sys.modules.setdefault('fauxmo', sys.modules[__name__])
+
+    serve_args = {'http_port': args.http_port, 'metrics_port': args.metrics_port,
+                  'coalesce_window': args.coalesce_window, 'idle_timeout': args.idle_timeout,
+                  'max_connections': args.max_connections,
+                  'max_device_connections': args.max_device_connections, 'ssdp_rate': args.ssdp_rate,
+                  'ssdp_burst': args.ssdp_burst, 'ssdp_suppress': args.ssdp_suppress,
+                  'state_file': args.state_file, 'action_timeout': args.action_timeout,
+                  'capture_file': args.capture, 'persona': args.persona,
+                  'state_export': args.state_export}
+    if args.config:
+        serve_args['config'] = args.config
+        serve_args['config_mtime'] = os.stat(args.config).st_mtime
+        serve_args['ip_address'], serve_args['devices'], serve_args['conflicts'] = load_config(args.config)
+        # What the config asked for, which a reload compares against
+        serve_args['config_ip_address'] = serve_args['ip_address']
+    if args.interface:
+        serve_args['ip_address'] = args.interface
+    if args.workers > 1:
+        REUSE_PORT = True
         try:
-            # Allow time for a ctrl-c to stop the process
-            p.poll(100)
-            #dbg('on')
-            status_led.on()
-            time.sleep(0.1)
-            #dbg('off')
-            status_led.off()
-        except Exception as e:
-            raise e
-
-finally:
-    GPIO.cleanup()
+            Supervisor(args.workers, serve_args).run()
+        except KeyboardInterrupt:
+            pass
+        return
+
+    run_worker(0, 1, serve_args)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,10 @@
 """
 GPIORPiPlugin.py :: Fauxmo plugin for simple RPi.GPIO.
+
+Loaded by this repository's fauxmo.py, the plugin shares its pin bank and
+pulse scheduler. Loaded by the fauxmo package it builds its own, and needs
+pinbank.py and pulses.py from this repository copied next to it (e.g. to
+~/ alongside ~/gpiorpiplugin.py, as in house.json).
 """
 try:
     import RPi.GPIO as GPIO
@@ -7,35 +12,69 @@ except ImportError:
     import testRPiGPIO as GPIO
 
     print('Using testRPiGPIO')
+import asyncio
 from functools import partialmethod  # type: ignore # not yet in typeshed
-from fauxmo.plugins import FauxmoPlugin
-from time import sleep
+try:
+    from fauxmo.plugins import FauxmoPlugin
+    LOG = BANK = PULSES = Pressed = None
+except ImportError:
+    # Loaded by this repository's fauxmo.py rather than the fauxmo package:
+    # share its pin bank and pulse scheduler, so that the pins our devices
+    # drive are set up, tracked and pulsed in one place
+    from fauxmo import FauxmoPlugin, LOG, BANK, PULSES, Pressed
+import os
 import sys
+import time
 
 DEBUG = True
 
 
 def dbg(msg):
     global DEBUG
-    if DEBUG:
+    if LOG is not None:
+        # fauxmo.py's event log decides whether this is shown (-d)
+        LOG.debug(msg)
+    elif DEBUG:
         print(msg)
         sys.stdout.flush()
 
 
+# Every pin used by any GPIORPiPlugin device is set up once in this bank,
+# which LEECH devices then drive as a single batch.
+if BANK is None:
+    # The fauxmo package imports us from our path alone; find the modules
+    # shipped next to us
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from pinbank import PinBank
+    from pulses import PulseScheduler
+
+    BANK = PinBank(GPIO)
+
+
 def gpio_handler(pins, state=None):
-    if type(pins) is not list:
-        pins = [pins]
-    if state == 'input':
-        for p in pins:
-            GPIO.input(p, state)
-    else:
-        for p in pins:
-            GPIO.output(p, state)
+    BANK.output(pins, state)
+
+
+# One-shot commands are released by this scheduler so the request handler
+# can return straight away. A pulse lasts PULSE_WIDTH seconds, and is kept
+# PULSE_GAP seconds away from the next pulse on the same pins.
+PULSE_WIDTH = 2
+PULSE_GAP = 0.5
+if PULSES is None:
+    PULSES = PulseScheduler(BANK.output, clock=getattr(GPIO, 'clock', time.monotonic))
 
 
 class GPIORPiPlugin(FauxmoPlugin):
     """Fauxmo Plugin for running commands on the local machine."""
 
+    # Called with the new on/off state whenever a command changes it, so the
+    # server can answer status queries without touching GPIO.
+    state_listener = None
+
+    # on/off only hand pins to the pin bank and pulse scheduler and return
+    # straight away, so fauxmo.py needn't run them in its thread pool.
+    blocking = False
+
     def __init__(self, *, name: str, port: int, on_cmd: int, off_cmd: int, pin: int or list, mode: str,
                  switching_type: str) -> None:
         """Initialize a GPIORPiPlugin instance.
@@ -54,17 +93,15 @@ class GPIORPiPlugin(FauxmoPlugin):
         self.mode = mode
         self.switching_type = switching_type
         if mode == 'BCM':
-            GPIO.setmode(GPIO.BCM)
-            GPIO.setup(self.pin, GPIO.OUT)
-            self.internal_state = GPIO.input(self.pin)
+            BANK.setup(self.pin, GPIO.BCM)
+            self.internal_state = BANK.level(self.pin)
         elif mode == 'BOARD':
-            GPIO.setmode(GPIO.BOARD)
-            GPIO.setup(self.pin, GPIO.OUT)
-            self.internal_state = GPIO.input(self.pin)
+            BANK.setup(self.pin, GPIO.BOARD)
+            self.internal_state = BANK.level(self.pin)
         elif mode == 'LEECH':
             if type(self.pin) is list:
                 for p in self.pin:
-                    if GPIO.gpio_function(p) != GPIO.OUT:
+                    if not BANK.configured(p):
                         raise Exception('Pin %i has not been defined as standalone switch' % p)
             elif type(self.pin) is int:
                 dbg('Leech Mode Set for pin %i' % self.pin)
@@ -83,10 +120,51 @@ class GPIORPiPlugin(FauxmoPlugin):
                  use to get the instance attribute.
         """
         state = getattr(self, cmd)
-        gpio_handler(self.pin, state)
-        sleep(2)
-        gpio_handler(self.pin, 1 - state)
+        pin = tuple(self.pin) if type(self.pin) is list else self.pin
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is None or Pressed is None:
+            PULSES.pulse(pin, PULSE_WIDTH, level=state, rest=1 - state)
+            result = True
+        else:
+            result = loop.create_future()
+            press = loop.create_task(self.press(pin, state, result, PULSES.claim(pin)))
+            result.add_done_callback(lambda started: started.cancelled() and press.cancel())
         self.internal_state = state
+        self.report_state(cmd)
+        return result
+
+    async def press(self, pin, state: int, started, ticket) -> bool:
+        """Pulse `pin` once it is our turn, and wait for its release.
+
+        Run by `oneshot` on fauxmo.py's event loop. The command is answered
+        as soon as the pulse starts, through `started`; this task, handed
+        over as its `Pressed.released`, holds the device's next command until
+        the pulse is over and PULSE_GAP has passed.
+        Args:
+            pin: Pin, or tuple of pins, to pulse
+            state: Level to pulse them to
+            started: Future resolved once the pulse has started
+            ticket: Our place in line for the pins, from `PULSES.claim`
+        """
+        pins = pin if type(pin) is tuple else (pin,)
+        try:
+            while not all(PULSES.ready(one, ticket) for one in pins):
+                for one in pins:
+                    await PULSES.turn(ticket, one)
+                await asyncio.sleep(PULSE_GAP)
+            released = asyncio.get_running_loop().create_future()
+            PULSES.pulse(pin, PULSE_WIDTH, level=state, rest=1 - state,
+                         done=lambda: released.done() or released.set_result(True))
+        finally:
+            PULSES.unclaim(ticket, pin)
+        if not started.done():
+            started.set_result(Pressed(asyncio.current_task()))
+        await released
+        # Keep the next command's pulse apart from this one
+        await asyncio.sleep(PULSE_GAP)
         return True
 
     def toggle(self, cmd: str) -> bool:
@@ -96,13 +174,27 @@ class GPIORPiPlugin(FauxmoPlugin):
                  use to get the instance attribute.
         """
         state = getattr(self, cmd)
-        gpio_handler(self.pin, state)
-        self.internal_state = GPIO.input(self.pin)
+        BANK.output(self.pin, state)
+        self.internal_state = state
+        self.report_state(cmd)
         return True
 
+    def report_state(self, cmd: str) -> None:
+        """Tell the state listener, if any, which command was last applied."""
+        if self.state_listener is not None:
+            self.state_listener(cmd == "on_cmd")
+
     def run_cmd(self, cmd: str):
         return self.func(cmd)
 
+    def restore_state(self, state: int) -> None:
+        """Take the last known state from fauxmo's journal instead of the pin."""
+        self.internal_state = 1 if state else 0
+
+    def cancel(self) -> bool:
+        """End a one-shot pulse in flight early, restoring its pin now."""
+        return PULSES.cancel(tuple(self.pin) if type(self.pin) is list else self.pin)
+
     on = partialmethod(run_cmd, "on_cmd")
     off = partialmethod(run_cmd, "off_cmd")
 
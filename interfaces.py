@@ -0,0 +1,111 @@
+"""
+interfaces.py :: Local IPv4 interfaces, found without touching the network.
+"""
+import socket
+import struct
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Linux ioctls for reading one interface's flags, address and netmask
+SIOCGIFFLAGS = 0x8913
+SIOCGIFADDR = 0x8915
+SIOCGIFNETMASK = 0x891b
+IFF_UP = 0x1
+IFF_LOOPBACK = 0x8
+
+
+class Interface(object):
+    """One IPv4 address of the host, with the subnet it is on."""
+
+    def __init__(self, name: str, address: str, netmask: str = '255.255.255.255', loopback: bool = False) -> None:
+        self.name = name
+        self.address = address
+        self.netmask = netmask
+        self.loopback = loopback
+        self.mask = struct.unpack('!I', socket.inet_aton(netmask))[0]
+        self.network = struct.unpack('!I', socket.inet_aton(address))[0] & self.mask
+
+    def __contains__(self, address: str) -> bool:
+        """Whether `address` is on this interface's subnet."""
+        return struct.unpack('!I', socket.inet_aton(address))[0] & self.mask == self.network
+
+    def __repr__(self) -> str:
+        return 'Interface(%r, %r, %r)' % (self.name, self.address, self.netmask)
+
+
+def _ioctl(sock, request, name):
+    return fcntl.ioctl(sock.fileno(), request, struct.pack('256s', name.encode()[:15]))
+
+
+def enumerate_interfaces() -> list:
+    """Every IPv4 interface that is up, read from the kernel.
+
+    Nothing is sent and no route is needed, so this works on an isolated
+    network. Where the interface ioctls aren't available, falls back to the
+    addresses the host name resolves to.
+    """
+    found = []
+    if fcntl is not None and hasattr(socket, 'if_nameindex'):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for index, name in socket.if_nameindex():
+                try:
+                    flags = struct.unpack('H', _ioctl(sock, SIOCGIFFLAGS, name)[16:18])[0]
+                    if not flags & IFF_UP:
+                        continue
+                    address = socket.inet_ntoa(_ioctl(sock, SIOCGIFADDR, name)[20:24])
+                    netmask = socket.inet_ntoa(_ioctl(sock, SIOCGIFNETMASK, name)[20:24])
+                except OSError:
+                    # No IPv4 address on this interface
+                    continue
+                found.append(Interface(name, address, netmask, bool(flags & IFF_LOOPBACK)))
+        finally:
+            sock.close()
+    if not found:
+        try:
+            addresses = socket.gethostbyname_ex(socket.gethostname())[2]
+        except OSError:
+            addresses = []
+        for address in addresses:
+            found.append(Interface(address, address, loopback=address.startswith('127.')))
+    return found
+
+
+def resolve(spec) -> list:
+    """Interfaces to serve on, from an address or interface name or a list of them.
+    Args:
+        spec: None or "auto" for every interface that is up other than
+              loopback, otherwise IP addresses and/or interface names
+    Returns:
+        Matching interfaces, falling back to loopback if nothing else is up
+    """
+    available = enumerate_interfaces()
+    if spec is None or spec == 'auto':
+        chosen = [interface for interface in available if not interface.loopback]
+    else:
+        if isinstance(spec, str):
+            spec = [spec]
+        chosen = []
+        for wanted in spec:
+            matches = [interface for interface in available if wanted in (interface.name, interface.address)]
+            if not matches:
+                # Not a local interface we can see; trust the address as given
+                try:
+                    matches = [Interface(wanted, wanted)]
+                except OSError:
+                    raise Exception('No interface or IPv4 address called %s' % wanted)
+            chosen.extend(match for match in matches if match not in chosen)
+    if not chosen:
+        chosen = [interface for interface in available if interface.loopback] or [Interface('lo', '127.0.0.1')]
+    return chosen
+
+
+def local_address(interfaces, sender: str) -> str:
+    """Address of whichever of `interfaces` is on the same subnet as `sender`, else the first one."""
+    for interface in interfaces:
+        if sender in interface:
+            return interface.address
+    return interfaces[0].address
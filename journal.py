@@ -0,0 +1,111 @@
+"""
+journal.py :: Append-only, memory-mapped journal of device states.
+"""
+import asyncio
+import mmap
+import os
+import struct
+import time
+import zlib
+
+MAGIC = b'FXJ1'
+HEADER = struct.Struct('<4sI')     # magic, number of records
+RECORD = struct.Struct('<dIB3x')   # wall-clock time, device key, state
+
+
+def device_key(name: str) -> int:
+    """Fixed-size key for a device name, as stored in each record."""
+    return zlib.crc32(name.encode())
+
+
+class StateJournal(object):
+    """Every device state change, appended to a memory-mapped file.
+
+    The file is allocated at its full size up front and holds a short header
+    followed by fixed-size records. Appending is a store into the mapping
+    plus a header update, so recording a change costs no system call; the
+    kernel writes the pages back, and `maintain` flushes them periodically.
+    Once the journal fills up it is compacted to the latest record per
+    device, written to a new file that replaces the old one.
+    """
+
+    def __init__(self, path: str, capacity: int = 4096) -> None:
+        """Open or create a StateJournal.
+        Args:
+            path: File holding the journal
+            capacity: Records the file has room for before it is compacted
+        """
+        self.path = path
+        self.capacity = capacity
+        self.size = HEADER.size + capacity * RECORD.size
+        self.latest = {}
+        self.dirty = False
+        self._map = None
+        self._open()
+
+    def _open(self) -> None:
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < self.size:
+                os.ftruncate(fd, self.size)
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, count = HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or count > self.capacity:
+            count = 0
+            HEADER.pack_into(self._map, 0, MAGIC, count)
+        self.count = count
+        # Restoring is one pass over the records already in memory
+        latest = self.latest
+        for stamp, key, state in RECORD.iter_unpack(self._map[HEADER.size:HEADER.size + count * RECORD.size]):
+            latest[key] = (state, stamp)
+
+    def state(self, name: str):
+        """Last recorded state of device `name`, or None if it has none."""
+        entry = self.latest.get(device_key(name))
+        return None if entry is None else entry[0]
+
+    def record(self, name: str, state: int) -> None:
+        """Append a state change for device `name`."""
+        if self.count >= self.capacity:
+            self.compact()
+        key = device_key(name)
+        stamp = time.time()
+        RECORD.pack_into(self._map, HEADER.size + self.count * RECORD.size, stamp, key, state)
+        self.count += 1
+        HEADER.pack_into(self._map, 0, MAGIC, self.count)
+        self.latest[key] = (state, stamp)
+        self.dirty = True
+
+    def compact(self) -> None:
+        """Rewrite the journal as just the latest record for each device."""
+        tmp_path = self.path + '.tmp'
+        records = b''.join(RECORD.pack(stamp, key, state) for key, (state, stamp) in self.latest.items())
+        with open(tmp_path, 'wb') as tmp:
+            tmp.write(HEADER.pack(MAGIC, len(self.latest)) + records)
+            tmp.truncate(self.size)
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        self._map.close()
+        os.replace(tmp_path, self.path)
+        self._open()
+        self.dirty = False
+
+    def flush(self) -> None:
+        if self.dirty:
+            self._map.flush()
+            self.dirty = False
+
+    async def maintain(self, interval: float = 5) -> None:
+        """Flush to disk every `interval` seconds, compacting once half full."""
+        while True:
+            await asyncio.sleep(interval)
+            if self.count > self.capacity // 2 and self.count > len(self.latest):
+                self.compact()
+            else:
+                self.flush()
+
+    def close(self) -> None:
+        self.flush()
+        self._map.close()
@@ -0,0 +1,147 @@
+"""
+metrics.py :: Always-on counters and latency histograms, served as Prometheus text.
+"""
+import asyncio
+from array import array
+from bisect import bisect_left
+
+# Upper bounds, in seconds, of the default latency buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def format_labels(labels, extra=None) -> str:
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, str(value).replace('\\', '\\\\').replace('"', '\\"')
+                                                .replace('\n', '\\n')) for name, value in items)
+
+
+class Counter(object):
+    """A monotonically increasing count."""
+
+    def __init__(self, labels) -> None:
+        self.labels = labels
+        self.value = 0
+
+    def inc(self, amount: int = 1) -> None:
+        self.value += amount
+
+    def render(self, name, lines) -> None:
+        lines.append('%s%s %d' % (name, format_labels(self.labels), self.value))
+
+
+class Gauge(object):
+    """A value that can go up and down, such as a configured limit."""
+
+    def __init__(self, labels) -> None:
+        self.labels = labels
+        self.value = 0
+
+    def set(self, value) -> None:
+        self.value = value
+
+    def render(self, name, lines) -> None:
+        lines.append('%s%s %r' % (name, format_labels(self.labels), self.value))
+
+
+class Histogram(object):
+    """Fixed-bucket histogram.
+
+    Bucket counts live in an array allocated up front, so recording a sample
+    is a bisect over a handful of bounds and one increment.
+    """
+
+    def __init__(self, labels, buckets=LATENCY_BUCKETS) -> None:
+        self.labels = labels
+        self.bounds = tuple(buckets)
+        self.counts = array('Q', [0] * (len(self.bounds) + 1))
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+    def render(self, name, lines) -> None:
+        cumulative = 0
+        for bound, count in zip(self.bounds + ('+Inf',), self.counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (name, format_labels(self.labels, ('le', bound)), cumulative))
+        lines.append('%s_sum%s %r' % (name, format_labels(self.labels), self.sum))
+        lines.append('%s_count%s %d' % (name, format_labels(self.labels), cumulative))
+
+
+class Registry(object):
+    """All metric families, keyed by name, each holding one metric per label set."""
+
+    def __init__(self) -> None:
+        self.families = {}
+
+    def _get(self, kind, name, help, labels, factory):
+        family = self.families.get(name)
+        if family is None:
+            family = self.families[name] = (kind, help, {})
+        elif family[0] != kind:
+            raise Exception('Metric %s is already registered as a %s' % (name, family[0]))
+        key = tuple(sorted(labels.items()))
+        metric = family[2].get(key)
+        if metric is None:
+            metric = family[2][key] = factory(key)
+        return metric
+
+    def counter(self, name: str, help: str, **labels) -> Counter:
+        """Return the counter for `name` and `labels`, creating it if needed."""
+        return self._get('counter', name, help, labels, Counter)
+
+    def gauge(self, name: str, help: str, **labels) -> Gauge:
+        """Return the gauge for `name` and `labels`, creating it if needed."""
+        return self._get('gauge', name, help, labels, Gauge)
+
+    def histogram(self, name: str, help: str, buckets=LATENCY_BUCKETS, **labels) -> Histogram:
+        """Return the histogram for `name` and `labels`, creating it if needed."""
+        return self._get('histogram', name, help, labels, lambda key: Histogram(key, buckets))
+
+    def render(self) -> bytes:
+        lines = []
+        for name, (kind, help, metrics) in sorted(self.families.items()):
+            lines.append('# HELP %s %s' % (name, help))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for metric in metrics.values():
+                metric.render(name, lines)
+        lines.append('')
+        return '\n'.join(lines).encode()
+
+
+REGISTRY = Registry()
+
+
+async def monitor_loop_lag(histogram, interval: float = 0.5) -> None:
+    """Record how late the event loop wakes a task that asked to sleep `interval`."""
+    loop = asyncio.get_running_loop()
+    while True:
+        expected = loop.time() + interval
+        await asyncio.sleep(interval)
+        histogram.observe(max(0.0, loop.time() - expected))
+
+
+async def serve_metrics(port: int, host: str = '127.0.0.1', registry: Registry = REGISTRY):
+    """Serve `registry` as Prometheus text on every GET to `host:port`."""
+
+    async def handle(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = registry.render()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: %d\r\n'
+                         b'Connection: close\r\n'
+                         b'\r\n' % len(body) + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
@@ -0,0 +1,89 @@
+"""
+pinbank.py :: Shared bank of GPIO output pins with cached state.
+"""
+
+
+def as_pins(pins) -> tuple:
+    """Normalise a single pin or a list/tuple of pins to a tuple."""
+    if type(pins) in (list, tuple):
+        return tuple(pins)
+    return (pins,)
+
+
+class PinBank(object):
+    """Every output pin, set up once and tracked in memory.
+
+    Two things are cached per pin: `levels`, the value last written to the
+    hardware, and `states`, the logical state of whatever the pin drives (for
+    a one-shot relay the latch it toggles, for a plain switch the same as
+    its level). Neither is ever read back from the hardware after setup.
+    """
+
+    def __init__(self, gpio, mode=None) -> None:
+        """Initialize a PinBank.
+        Args:
+            gpio: The GPIO module to drive, e.g. RPi.GPIO
+            mode: GPIO numbering mode; defaults to the first mode passed to
+                  `setup`, or BCM
+        """
+        self.gpio = gpio
+        self.mode = mode
+        self.mode_set = False
+        self.levels = {}
+        self.states = {}
+        self.listeners = {}
+
+    def setup(self, pins, mode=None) -> None:
+        """Configure any of `pins` that aren't already set up as outputs."""
+        new = [pin for pin in as_pins(pins) if pin not in self.levels]
+        if not new:
+            return
+        if mode is not None and self.mode is not None and mode != self.mode:
+            raise Exception('Pin bank is in %s mode, cannot set up pins in %s mode' % (self.mode, mode))
+        if not self.mode_set:
+            self.mode = mode or self.mode or self.gpio.BCM
+            self.gpio.setmode(self.mode)
+            self.mode_set = True
+        for pin in new:
+            self.gpio.setup(pin, self.gpio.OUT)
+            level = self.gpio.input(pin) or 0
+            self.levels[pin] = level
+            self.states[pin] = level
+
+    def configured(self, pin) -> bool:
+        return pin in self.levels
+
+    def output(self, pins, level) -> None:
+        """Write `level` to one pin or a whole batch of pins at once."""
+        levels = self.levels
+        write = self.gpio.output
+        for pin in as_pins(pins):
+            write(pin, level)
+            levels[pin] = level
+
+    def level(self, pin):
+        return self.levels[pin]
+
+    def state(self, pin):
+        return self.states[pin]
+
+    def set_state(self, pins, state) -> None:
+        """Record the logical state of one or more pins and tell listeners."""
+        for pin in as_pins(pins):
+            if self.states.get(pin) == state:
+                continue
+            self.states[pin] = state
+            for listener in self.listeners.get(pin, ()):
+                listener(state)
+
+    def add_listener(self, pin, listener) -> None:
+        """Call `listener(state)` whenever the logical state of `pin` changes."""
+        self.listeners.setdefault(pin, []).append(listener)
+
+    def remove_listener(self, pin, listener) -> None:
+        """Stop calling `listener` for `pin`."""
+        listeners = self.listeners.get(pin)
+        if listeners and listener in listeners:
+            listeners.remove(listener)
+            if not listeners:
+                del self.listeners[pin]
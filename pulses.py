@@ -0,0 +1,199 @@
+"""
+pulses.py :: Non-blocking pulse scheduler for one-shot GPIO outputs.
+"""
+import asyncio
+import collections
+import heapq
+import time
+
+from pinbank import as_pins
+
+
+class PulseScheduler(object):
+    """Set a pin now and put it back on a timer instead of sleeping.
+
+    Pending restores are kept in a heap ordered by deadline. Only the earliest
+    one has a callback armed on the event loop, so any number of overlapping
+    pulses costs a single timer.
+
+    A pulse may drive a group of pins as one batch. Pending pulses are also
+    indexed by every individual pin they drive, so a pin is seen as busy
+    whether it is pulsing on its own or as part of a group.
+
+    Presses that have to wait for a busy pin `claim` it, and take their
+    turns on it in the order they claimed it.
+    """
+
+    def __init__(self, output, clock=time.monotonic) -> None:
+        """Initialize a PulseScheduler.
+        Args:
+            output: Callable taking `(pin, level)` that drives the hardware
+            clock: Monotonic clock returning seconds, shared by every pulse
+        """
+        self.output = output
+        self.clock = clock
+        self._heap = []
+        self._pending = {}
+        self._claims = {}
+        self._idle_waiters = []
+        self._timer = None
+        self._timer_deadline = None
+        self._seq = 0
+
+    def pulse(self, pin, width: float, level=1, rest=0, done=None) -> None:
+        """Drive `pin` to `level` and schedule it back to `rest`.
+
+        None of the pins should already be pulsing as part of a different
+        group; callers check `active` (or wait on `idle`) first.
+        Args:
+            pin: Pin, or tuple of pins written as one batch by `output`
+            width: Pulse width in seconds
+            level: Value written at the start of the pulse
+            rest: Value written once the pulse has elapsed
+            done: Optional callable run after the pin has been restored
+        """
+        pins = as_pins(pin)
+        dones = [done] if done is not None else []
+        # Re-triggering a pin that is already pulsing extends the pulse
+        # rather than stacking a second restore behind it.
+        previous = self._pending.get(pins[0])
+        if previous is not None and previous[2] == pin:
+            self._drop(previous)
+            dones[:0] = previous[4]
+        self.output(pin, level)
+        self._seq += 1
+        entry = [self.clock() + width, self._seq, pin, rest, dones, True]
+        for one in pins:
+            self._pending[one] = entry
+        heapq.heappush(self._heap, entry)
+        self._arm()
+
+    def cancel(self, pin, restore: bool = True) -> bool:
+        """Drop the pending restore for `pin` (and any group it is pulsing
+        with), optionally restoring it now."""
+        entry = self._pending.get(as_pins(pin)[0])
+        if entry is None:
+            return False
+        self._drop(entry)
+        if restore:
+            self._finish(entry)
+        else:
+            self._wake()
+        return True
+
+    def active(self, pin) -> bool:
+        """Whether `pin`, or any pin of a group, is pulsing."""
+        return any(one in self._pending for one in as_pins(pin))
+
+    def claim(self, pins):
+        """Join the line of presses waiting for each of `pins`.
+        Returns:
+            A ticket for `ready`, `turn` and `unclaim`
+        """
+        ticket = object()
+        for one in as_pins(pins):
+            self._claims.setdefault(one, collections.deque()).append(ticket)
+        return ticket
+
+    def ready(self, pin, ticket=None) -> bool:
+        """Whether `pin` is idle and nobody ahead of `ticket` claims it."""
+        if pin in self._pending:
+            return False
+        claims = self._claims.get(pin)
+        return not claims or claims[0] is ticket
+
+    def unclaim(self, ticket, pins) -> None:
+        """Leave the line for each of `pins`, letting the next in line go."""
+        for one in as_pins(pins):
+            claims = self._claims.get(one)
+            if claims and ticket in claims:
+                claims.remove(ticket)
+                if not claims:
+                    del self._claims[one]
+        self._wake()
+
+    async def turn(self, ticket, pins) -> None:
+        """Wait until `ticket` may press at least one of `pins`."""
+        while not any(self.ready(one, ticket) for one in as_pins(pins)):
+            waiter = asyncio.get_running_loop().create_future()
+            self._idle_waiters.append(waiter)
+            await waiter
+
+    async def idle(self, pins) -> None:
+        """Wait until none of `pins` is pulsing."""
+        while self.active(pins):
+            waiter = asyncio.get_running_loop().create_future()
+            self._idle_waiters.append(waiter)
+            await waiter
+
+    def next_deadline(self):
+        """Deadline of the earliest live pulse, or None when idle."""
+        heap = self._heap
+        while heap and not heap[0][5]:
+            heapq.heappop(heap)
+        return heap[0][0] if heap else None
+
+    def run_due(self, now=None) -> int:
+        """Restore every pulse whose deadline has passed.
+
+        Called from the armed loop timer; callers without an event loop (or
+        with a virtual clock) may drive it directly.
+        Returns:
+            Number of pulses completed
+        """
+        if now is None:
+            now = self.clock()
+        heap = self._heap
+        completed = 0
+        while heap and heap[0][0] <= now:
+            entry = heapq.heappop(heap)
+            if not entry[5]:
+                continue
+            self._drop(entry)
+            self._finish(entry)
+            completed += 1
+        self._arm()
+        return completed
+
+    def _drop(self, entry) -> None:
+        pending = self._pending
+        for one in as_pins(entry[2]):
+            if pending.get(one) is entry:
+                del pending[one]
+        entry[5] = False
+
+    def _finish(self, entry) -> None:
+        self.output(entry[2], entry[3])
+        for done in entry[4]:
+            done()
+        self._wake()
+
+    def _wake(self) -> None:
+        waiters = self._idle_waiters
+        self._idle_waiters = []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _fire(self) -> None:
+        self._timer = None
+        self._timer_deadline = None
+        self.run_due()
+
+    def _arm(self) -> None:
+        deadline = self.next_deadline()
+        if deadline == self._timer_deadline:
+            return
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+            self._timer_deadline = None
+        if deadline is None:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # No loop in this thread: whoever owns the clock calls run_due().
+            return
+        self._timer = loop.call_later(max(0.0, deadline - self.clock()), self._fire)
+        self._timer_deadline = deadline
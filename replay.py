@@ -0,0 +1,221 @@
+"""
+replay.py :: Play a fauxmo traffic capture back against a running instance.
+
+Reads a file written by `fauxmo.py --capture`, re-sends every recorded
+search and TCP payload to HOST (loopback by default) on its original
+schedule, divided by --speed, and compares what comes back with what was
+recorded. Each recorded search sender and TCP connection gets its own
+socket, so bursts, retries and requests split over several segments are
+reproduced as they arrived. Response bodies and first-byte latencies are
+compared and printed as JSON.
+
+    python fauxmo.py --capture echo.cap        # on site, then later:
+    python replay.py echo.cap --speed 10
+    python replay.py echo.cap --speed 0 --ignore LOCATION
+"""
+import argparse
+import asyncio
+import json
+import time
+
+from bench import percentiles
+from capture import CLOSE, DATA, OPEN, REPLY, SEARCH, SENT, read_capture
+
+
+class Stream(object):
+    """One recorded search sender or TCP connection, and what happened when it was replayed."""
+
+    def __init__(self, key, local_port: int) -> None:
+        self.key = key
+        self.local_port = local_port
+        self.inbound = []
+        self.expected = []
+        self.closes = None
+        self.recorded_latencies = []
+        self.received = []
+        self.latencies = []
+        self.waiting = None
+        self._recorded_waiting = None
+
+    def saw_inbound(self, stamp: float, data: bytes) -> None:
+        self.inbound.append((stamp, data))
+        if self._recorded_waiting is None:
+            self._recorded_waiting = stamp
+
+    def saw_outbound(self, stamp: float, data: bytes) -> None:
+        self.expected.append(data)
+        if self._recorded_waiting is not None:
+            self.recorded_latencies.append(stamp - self._recorded_waiting)
+            self._recorded_waiting = None
+
+    def sent(self) -> None:
+        if self.waiting is None:
+            self.waiting = time.perf_counter()
+
+    def got(self, data: bytes) -> None:
+        self.received.append(data)
+        if self.waiting is not None:
+            self.latencies.append(time.perf_counter() - self.waiting)
+            self.waiting = None
+
+
+class ReplayConnection(asyncio.Protocol):
+    def __init__(self, stream: Stream) -> None:
+        self.stream = stream
+        self.closed = asyncio.get_running_loop().create_future()
+
+    def data_received(self, data) -> None:
+        self.stream.got(data)
+
+    def connection_lost(self, exc) -> None:
+        if not self.closed.done():
+            self.closed.set_result(None)
+
+
+class ReplaySender(asyncio.DatagramProtocol):
+    def __init__(self, stream: Stream) -> None:
+        self.stream = stream
+
+    def datagram_received(self, data, addr) -> None:
+        self.stream.got(data)
+
+
+def load_streams(path: str):
+    """Group the records in `path` by search sender and TCP connection."""
+    streams = {}
+    count = 0
+    for stamp, stream_id, kind, peer, local_port, payload in read_capture(path):
+        count += 1
+        key = ('udp', peer) if stream_id == 0 else ('tcp', stream_id)
+        stream = streams.get(key)
+        if stream is None:
+            stream = streams[key] = Stream(key, local_port)
+        if kind in (SEARCH, DATA):
+            stream.saw_inbound(stamp, payload)
+        elif kind in (REPLY, SENT):
+            stream.saw_outbound(stamp, payload)
+        elif kind == CLOSE:
+            stream.closes = stamp
+        elif kind == OPEN and not stream.inbound:
+            stream.inbound.append((stamp, None))
+    return count, list(streams.values())
+
+
+async def play(stream: Stream, args, start: float) -> None:
+    """Send one stream's inbound traffic on its recorded schedule."""
+    loop = asyncio.get_running_loop()
+
+    async def until(stamp):
+        if args.speed:
+            delay = start + stamp / args.speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+
+    if stream.key[0] == 'udp':
+        transport, _ = await loop.create_datagram_endpoint(lambda: ReplaySender(stream),
+                                                           local_addr=(args.host, 0))
+        for stamp, data in stream.inbound:
+            await until(stamp)
+            stream.sent()
+            transport.sendto(data, (args.host, args.ssdp_port or stream.local_port))
+        await asyncio.sleep(args.settle)
+        transport.close()
+        return
+
+    await until(stream.inbound[0][0] if stream.inbound else 0)
+    try:
+        transport, connection = await loop.create_connection(lambda: ReplayConnection(stream), args.host,
+                                                             stream.local_port + args.port_offset)
+    except OSError:
+        stream.received.append(None)
+        return
+    for stamp, data in stream.inbound:
+        if data is None:
+            continue
+        await until(stamp)
+        stream.sent()
+        transport.write(data)
+    try:
+        await asyncio.wait_for(asyncio.shield(connection.closed), args.settle)
+    except asyncio.TimeoutError:
+        pass
+    transport.close()
+
+
+def normalise(messages, ignore) -> list:
+    """Split responses into lines, dropping any header named in `ignore`."""
+    lines = []
+    for message in messages:
+        for line in message.split(b'\r\n'):
+            name = line.split(b':', 1)[0].strip().upper()
+            if name not in ignore:
+                lines.append(line)
+    return lines
+
+
+def compare(streams, ignore) -> dict:
+    report = {}
+    for kind in ('udp', 'tcp'):
+        chosen = [stream for stream in streams if stream.key[0] == kind]
+        if not chosen:
+            continue
+        mismatched = 0
+        for stream in chosen:
+            received = [data for data in stream.received if data is not None]
+            if kind == 'udp':
+                # Replies come back in random order within each search's MX
+                same = sorted(normalise(stream.expected, ignore)) == sorted(normalise(received, ignore))
+            else:
+                same = (normalise([b''.join(stream.expected)], ignore) ==
+                        normalise([b''.join(received)], ignore))
+            if not same:
+                mismatched += 1
+        recorded = [latency for stream in chosen for latency in stream.recorded_latencies]
+        replayed = [latency for stream in chosen for latency in stream.latencies]
+        name = 'ssdp' if kind == 'udp' else 'http'
+        report[name] = {'streams': len(chosen), 'mismatched': mismatched,
+                        'messages_sent': sum(1 for stream in chosen for _, data in stream.inbound
+                                             if data is not None),
+                        'responses_expected': sum(len(stream.expected) for stream in chosen),
+                        'recorded': percentiles(recorded), 'replayed': percentiles(replayed)}
+    return report
+
+
+async def replay(args) -> dict:
+    count, streams = load_streams(args.capture)
+    start = time.perf_counter()
+    await asyncio.gather(*(play(stream, args, start) for stream in streams))
+    elapsed = time.perf_counter() - start
+    report = {'capture': args.capture, 'records': count, 'speed': args.speed or 'max',
+              'wall_seconds': elapsed}
+    report.update(compare(streams, {name.upper().encode() for name in args.ignore}))
+    return report
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Replay a fauxmo traffic capture against a running instance")
+    parser.add_argument('capture', help="file written by fauxmo.py --capture")
+    parser.add_argument('--host', default='127.0.0.1', help="address of the instance to replay against")
+    parser.add_argument('--speed', type=float, default=1,
+                        help="replay this many times faster than recorded; 0 sends as fast as possible")
+    parser.add_argument('--ssdp-port', type=int, default=None,
+                        help="send searches to this port instead of the one they were captured on")
+    parser.add_argument('--port-offset', type=int, default=0,
+                        help="add this to each device port recorded in the capture")
+    parser.add_argument('--settle', type=float, default=2,
+                        help="seconds to wait for responses after a stream's last message")
+    parser.add_argument('--ignore', action='append', default=['DATE'],
+                        help="header to leave out when comparing responses; may be given more than once")
+    parser.add_argument('--output', default=None, help="also write the JSON report to this file")
+    args = parser.parse_args()
+
+    report = asyncio.run(replay(args))
+    text = json.dumps(report, indent=2)
+    print(text)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+"""
+sharedstate.py :: Device states published in a memory-mapped file, and a lock-free reader for them.
+
+fauxmo.py writes the file (see --state-export); anything else on the host
+can read it without talking to fauxmo or touching GPIO:
+
+    from sharedstate import read_states
+    for name, device in read_states('/run/fauxmo.state').items():
+        print(name, device.state, device.last_change, device.on_commands)
+"""
+import asyncio
+import collections
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'FXS1'
+HEADER = struct.Struct('<4sIIIQ')      # magic, record size, capacity, records in use, sequence
+FIELDS = struct.Struct('<4sIII')       # the header up to the sequence
+SEQUENCE = struct.Struct('<Q')
+SEQUENCE_OFFSET = FIELDS.size
+RECORD = struct.Struct('<48sB7xdQQQ')  # name, state, wall-clock time of last change, on, off and failed commands
+
+DeviceState = collections.namedtuple('DeviceState', 'state last_change on_commands off_commands failed_commands')
+
+
+class StateExport(object):
+    """Publish every device's state and command counts for other processes to read.
+
+    The file is a header followed by one fixed-size record per device, and
+    is guarded by a seqlock: the sequence number in the header is odd while
+    records are being written and is bumped to the next even number once
+    they are done. Readers copy the records and retry if the sequence was
+    odd or changed meanwhile, so they never block the writer or each other.
+
+    Marking a device changed only adds it to a set. The records are written
+    in one batch by a callback scheduled on the event loop, after the
+    request that changed them has been answered.
+    """
+
+    def __init__(self, path: str, capacity: int = 256) -> None:
+        """Create or take over a StateExport.
+        Args:
+            path: File to publish to
+            capacity: Most devices the file has room for
+        """
+        self.path = path
+        self.capacity = capacity
+        self.size = HEADER.size + capacity * RECORD.size
+        self.slots = {}
+        self.free = []
+        self.count = 0
+        self.dirty = set()
+        self.scheduled = False
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != self.size:
+                os.ftruncate(fd, self.size)
+            self._map = mmap.mmap(fd, self.size)
+        finally:
+            os.close(fd)
+        magic, record_size, old_capacity, count, sequence = HEADER.unpack_from(self._map, 0)
+        # Readers may already have the file mapped, so keep its sequence moving forward
+        self.sequence = sequence + (sequence & 1) if magic == MAGIC else 0
+        self._begin()
+        self._map[HEADER.size:] = bytes(self.size - HEADER.size)
+        FIELDS.pack_into(self._map, 0, MAGIC, RECORD.size, capacity, 0)
+        self._end()
+
+    # pack_into clears its target before filling it in, which a reader could
+    # catch as an even sequence; the sequence is stored in one copy instead.
+    def _begin(self) -> None:
+        self.sequence += 1
+        self._map[SEQUENCE_OFFSET:HEADER.size] = SEQUENCE.pack(self.sequence)
+
+    def _end(self) -> None:
+        self.sequence += 1
+        self._map[SEQUENCE_OFFSET:HEADER.size] = SEQUENCE.pack(self.sequence)
+
+    def changed(self, device) -> None:
+        """Have `device`'s record rewritten shortly.
+
+        The device is read when the record is written: its `name`, `state`,
+        `last_change`, `commands_received` (indexed by command) and
+        `commands_failed`.
+        """
+        self.dirty.add(device)
+        if self.scheduled:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.publish()
+            return
+        self.scheduled = True
+        loop.call_soon(self.publish)
+
+    def remove(self, device) -> None:
+        self.dirty.discard(device)
+        slot = self.slots.pop(device, None)
+        if slot is None:
+            return
+        self.free.append(slot)
+        self._begin()
+        RECORD.pack_into(self._map, HEADER.size + slot * RECORD.size, b'', 0, 0, 0, 0, 0)
+        self._end()
+
+    def publish(self) -> None:
+        """Write the records of every device changed since the last publish."""
+        self.scheduled = False
+        if not self.dirty:
+            return
+        dirty = self.dirty
+        self.dirty = set()
+        self._begin()
+        for device in dirty:
+            slot = self.slots.get(device)
+            if slot is None:
+                if self.free:
+                    slot = self.free.pop()
+                elif self.count < self.capacity:
+                    slot = self.count
+                    self.count += 1
+                else:
+                    continue
+                self.slots[device] = slot
+            received = device.commands_received
+            RECORD.pack_into(self._map, HEADER.size + slot * RECORD.size, device.name.encode()[:48],
+                             device.state, device.last_change, received[1], received[0], device.commands_failed)
+        FIELDS.pack_into(self._map, 0, MAGIC, RECORD.size, self.capacity, self.count)
+        self._end()
+
+    def close(self) -> None:
+        self.publish()
+        self._map.close()
+
+
+class StateReader(object):
+    """Consistent snapshots of a file written by StateExport, read without locking."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        with open(path, 'rb') as export:
+            self._map = mmap.mmap(export.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def snapshot(self, timeout: float = 1.0) -> dict:
+        """Every device's DeviceState, by name, all as of the same moment.
+        Args:
+            timeout: Seconds to keep retrying while fauxmo is writing
+        Returns:
+            A dict of device name to DeviceState
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            before = SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0]
+            if not before & 1:
+                magic, record_size, capacity, count, _ = HEADER.unpack_from(self._map, 0)
+                records = self._map[HEADER.size:HEADER.size + count * RECORD.size]
+                if SEQUENCE.unpack_from(self._map, SEQUENCE_OFFSET)[0] == before:
+                    break
+            if time.monotonic() > deadline:
+                raise Exception('%s is being written and never settled' % self.path)
+        if magic != MAGIC or record_size != RECORD.size:
+            raise Exception('%s is not a fauxmo state export' % self.path)
+        states = {}
+        for name, state, last_change, on, off, failed in RECORD.iter_unpack(records):
+            # Freed and never used slots are all zeros
+            name = name.rstrip(b'\0')
+            if name:
+                states[name.decode('utf-8', 'replace')] = DeviceState(state, last_change, on, off, failed)
+        return states
+
+    def close(self) -> None:
+        self._map.close()
+
+
+def read_states(path: str) -> dict:
+    """One snapshot of the device states exported to `path`."""
+    reader = StateReader(path)
+    try:
+        return reader.snapshot()
+    finally:
+        reader.close()
@@ -1,36 +1,213 @@
 #!/usr/bin/python
-BOARD = "board"
-BCM = "bcm"
-OUT = "out"
-IN = "in"
+"""
+testRPiGPIO.py :: Simulated stand-in for RPi.GPIO with an optional virtual clock.
 
+Pin modes and levels live in fixed arrays and every change of level is
+appended to a transition log stamped by `clock()`. By default that is the
+real monotonic clock; after `use_clock(VirtualClock())` time only moves when
+`advance` is called, which also runs any pulse schedulers whose deadlines
+fall within the step. Pulse sequences can then be run and checked far
+faster than real time:
 
-def output(pin, value):
-    print(pin, ":", value)
+    clock = use_clock(VirtualClock())
+    scheduler = PulseScheduler(output, clock=clock)
+    scheduler.pulse(14, 2)
+    advance(5, [scheduler])
+    assert pulses(14) == [(0.0, 2.0)]
+"""
+import time
+from array import array
 
+BOARD = 10
+BCM = 11
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+PUD_OFF = 20
 
-def setmode(mode):
-    print(mode)
+MAX_PINS = 1024
+UNSET = -1
 
+# Set to print every call, as this module used to
+VERBOSE = False
 
-def setup(pin, value):
-    print(pin, ":", value)
+mode = None
+modes = array('b', [UNSET] * MAX_PINS)
+levels = array('B', [0] * MAX_PINS)
 
+# Transition log: one entry per change of level, in order
+log_times = array('d')
+log_pins = array('H')
+log_levels = array('B')
 
-def cleanup():
-    print("clean-up")
 
+class VirtualClock(object):
+    """A clock that only moves when told to."""
 
-def input(pin):
-    print(pin, ":")
+    def __init__(self, start: float = 0.0) -> None:
+        self.now = start
 
-    # End
+    def __call__(self) -> float:
+        return self.now
 
+    def advance(self, seconds: float) -> None:
+        self.now += seconds
 
-def gpio_function(pin):
-    print(pin, ":")
-    return OUT
+    def set(self, now: float) -> None:
+        self.now = now
+
+
+_clock = time.monotonic
+
+
+def clock() -> float:
+    """The current time on whichever clock is in use."""
+    return _clock()
+
+
+def use_clock(new_clock):
+    """Stamp transitions with `new_clock` from now on. Returns it."""
+    global _clock
+    _clock = new_clock
+    return new_clock
+
+
+def advance(seconds: float, schedulers=()) -> int:
+    """Move the virtual clock forward, firing due pulses at their exact deadlines.
+    Args:
+        seconds: How far to move the clock
+        schedulers: Pulse schedulers (with `next_deadline` and `run_due`)
+                    to run as the clock passes their deadlines
+    Returns:
+        Number of pulses completed
+    """
+    target = _clock() + seconds
+    completed = 0
+    while True:
+        deadlines = [deadline for deadline in (scheduler.next_deadline() for scheduler in schedulers)
+                     if deadline is not None and deadline <= target]
+        if not deadlines:
+            break
+        _clock.set(min(deadlines))
+        for scheduler in schedulers:
+            completed += scheduler.run_due()
+    _clock.set(target)
+    return completed
+
+
+def _say(*args):
+    if VERBOSE:
+        print(*args)
+
+
+def _channels(channel):
+    if type(channel) in (list, tuple):
+        return channel
+    return (channel,)
+
+
+def setmode(new_mode):
+    global mode
+    _say(new_mode)
+    mode = new_mode
+
+
+def getmode():
+    return mode
 
 
 def setwarnings(flag):
-    print('False')
+    _say('setwarnings', flag)
+
+
+def setup(channel, direction, pull_up_down=PUD_OFF, initial=None):
+    for pin in _channels(channel):
+        _say(pin, ":", direction)
+        modes[pin] = direction
+        if initial is not None:
+            _write(pin, initial)
+
+
+def _write(pin, value):
+    value = 1 if value else 0
+    if levels[pin] != value:
+        levels[pin] = value
+        log_times.append(_clock())
+        log_pins.append(pin)
+        log_levels.append(value)
+
+
+def output(channel, value):
+    values = _channels(value)
+    for index, pin in enumerate(_channels(channel)):
+        _say(pin, ":", value)
+        _write(pin, values[index] if len(values) > 1 else values[0])
+
+
+def input(pin):
+    _say(pin, ":")
+    return levels[pin]
+
+
+def gpio_function(pin):
+    _say(pin, ":")
+    return IN if modes[pin] == UNSET else modes[pin]
+
+
+def cleanup(channel=None):
+    global mode
+    _say("clean-up")
+    pins = range(MAX_PINS) if channel is None else _channels(channel)
+    for pin in pins:
+        modes[pin] = UNSET
+        levels[pin] = 0
+    if channel is None:
+        mode = None
+
+
+def reset_log():
+    del log_times[:]
+    del log_pins[:]
+    del log_levels[:]
+
+
+def transitions(pin=None) -> list:
+    """Logged `(time, pin, level)` transitions, for one pin or all of them."""
+    return [(log_times[i], log_pins[i], log_levels[i]) for i in range(len(log_times))
+            if pin is None or log_pins[i] == pin]
+
+
+def pulses(pin, active=HIGH) -> list:
+    """`(start, width)` of every completed period `pin` spent at `active`."""
+    found = []
+    start = None
+    for stamp, _, level in transitions(pin):
+        if level == active:
+            start = stamp
+        elif start is not None:
+            found.append((start, stamp - start))
+            start = None
+    return found
+
+
+def overlaps(pins, active=HIGH) -> list:
+    """`(start, end)` of every period when more than one of `pins` was at `active`."""
+    pins = set(pins)
+    high = set()
+    found = []
+    start = None
+    for i in range(len(log_times)):
+        pin = log_pins[i]
+        if pin not in pins:
+            continue
+        if log_levels[i] == active:
+            high.add(pin)
+        else:
+            high.discard(pin)
+        if len(high) > 1 and start is None:
+            start = log_times[i]
+        elif len(high) <= 1 and start is not None:
+            found.append((start, log_times[i]))
+            start = None
+    return found
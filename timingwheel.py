@@ -0,0 +1,67 @@
+"""
+timingwheel.py :: Timing wheel for expiring idle items with O(1) upkeep.
+"""
+import asyncio
+import math
+
+
+class TimingWheel(object):
+    """Expire items that haven't been touched for `timeout` seconds.
+
+    The wheel is a ring of buckets, each covering one `tick`. An item sits in
+    the bucket for the tick it will expire in; touching it just moves it to
+    the newest bucket. Every tick the oldest bucket is emptied and its items
+    expired, so upkeep is one set operation per touch and a single loop
+    timer, which only runs while the wheel holds anything. Items expire
+    within one tick of `timeout`.
+    """
+
+    def __init__(self, timeout: float, expire, tick: float = 1.0) -> None:
+        """Initialize a TimingWheel.
+        Args:
+            timeout: Seconds an item may go untouched
+            expire: Callable run with each item that times out
+            tick: Resolution of the wheel in seconds
+        """
+        self.timeout = timeout
+        self.expire = expire
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(timeout / tick)) + 1)]
+        self.where = {}
+        self.cursor = 0
+        self._timer = None
+
+    def __len__(self) -> int:
+        return len(self.where)
+
+    def touch(self, item) -> None:
+        """Add `item`, or restart its timeout if it is already on the wheel."""
+        target = self.cursor - 1
+        if target < 0:
+            target += len(self.slots)
+        slot = self.where.get(item)
+        if slot == target:
+            return
+        if slot is not None:
+            self.slots[slot].discard(item)
+        self.slots[target].add(item)
+        self.where[item] = target
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.tick, self._advance)
+
+    def discard(self, item) -> None:
+        slot = self.where.pop(item, None)
+        if slot is not None:
+            self.slots[slot].discard(item)
+
+    def _advance(self) -> None:
+        self._timer = None
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        expired = self.slots[self.cursor]
+        self.slots[self.cursor] = set()
+        for item in expired:
+            del self.where[item]
+        for item in expired:
+            self.expire(item)
+        if self.where:
+            self._timer = asyncio.get_running_loop().call_later(self.tick, self._advance)